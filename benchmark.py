@@ -0,0 +1,498 @@
+"""Benchmark fleet operations against local stand-ins.
+
+Every ssh process maintenance.py would spawn is intercepted and answered by an
+in-memory fake host, and the GitHub / Cloudflare / Telegram APIs are served by a local
+HTTP server. Both inject a configurable per-hop latency. For each fleet size the
+check, check_and_fix (cold and warm), deploy and restart actions are timed and the
+round-trips, bytes transferred (controller and peer-to-peer) and process spawns are
+reported. --dead makes some hosts never answer (each connection attempt waits out
+--connect-timeout) to measure how much broken hosts slow a batch down.
+
+    python3 benchmark.py --sizes 1,10,100 --latency 0.05 --concurrency 16
+"""
+import argparse
+import gzip
+import hashlib
+import http.server
+import io
+import json
+import os
+import random
+import shlex
+import struct
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import types
+import zlib
+
+BENCH_DIR = tempfile.mkdtemp(prefix="gb-bench-")
+os.environ.update({
+    "GRAVITY_CACHE_DIR": os.path.join(BENCH_DIR, "cache"),
+    "SSH_CONTROL_DIR": os.path.join(BENCH_DIR, "ssh"),
+    "GH_TOKEN": "bench-token",
+    "SSH_PASSWORD": "bench-pass",
+    "TELEGRAM_BOT_TOKEN": "bench",
+    "TELEGRAM_CHAT_ID": "1",
+    "CF_API_EMAIL": "bench@example.com", "CF_API_KEY": "bench", "CF_ZONE_ID": "zone-a",
+    "CF_API_EMAIL_555606": "bench@example.com", "CF_API_KEY_555606": "bench", "CF_ZONE_ID_555606": "zone-b",
+    "TG_COALESCE_SECONDS": "0",
+    "READY_MIN_UPTIME": "0",
+})
+os.makedirs(os.environ["SSH_CONTROL_DIR"], exist_ok=True)
+
+import maintenance as m  # noqa: E402  (environment must be set first)
+
+BINARY_SIZE = 4 * 1024 * 1024
+
+
+class Counters:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.spawns = 0
+        self.round_trips = 0
+        self.handshakes = 0
+        self.http_requests = 0
+        self.bytes_up = 0
+        self.bytes_down = 0
+        self.bytes_peer = 0
+
+    def add(self, **kw):
+        with self.lock:
+            for k, v in kw.items():
+                setattr(self, k, getattr(self, k) + v)
+
+
+COUNTERS = Counters()
+
+
+def make_releases():
+    rnd = random.Random(42)
+    old = bytes(rnd.getrandbits(8) for _ in range(BINARY_SIZE))
+    new = bytearray(old)
+    # A new release touches a few regions of the binary
+    for offset in (BINARY_SIZE // 5, BINARY_SIZE // 2, BINARY_SIZE - 4096):
+        new[offset:offset + 2048] = bytes(rnd.getrandbits(8) for _ in range(2048))
+    return old, bytes(new)
+
+
+OLD_BINARY, NEW_BINARY = make_releases()
+
+
+# ---------------------------------------------------------------------------
+# Fake SSH fleet
+# ---------------------------------------------------------------------------
+
+CONFIG_KEYS = {"mcp_config.json": "mcp", "GEMINI.md": "rules", ".env": "env"}  # m.CONFIG_FILES -> FakeHost.files
+
+
+class FakeHost:
+    def __init__(self, name):
+        self.name = name
+        # Deployed on the previous release, with config, .env and templates in place
+        self.binary = OLD_BINARY
+        self.templates = {n: h for n, h in m.local_template_manifest().items()}
+        self.files = {"mcp": b"{}", "rules": b"rules", "env": b"AGENT_NAME=" + name.encode()}
+        self.deps = True
+        self.releases = {}
+        self.pid = 1000
+        self.started = time.time() - 3600
+        self.lock = threading.Lock()
+
+    def sha256(self, data):
+        return hashlib.sha256(data).hexdigest() if data is not None else ""
+
+    def binary_digest(self):
+        # Digest sidecar: the binary is only re-hashed after it was replaced
+        if getattr(self, "sidecar", (None,))[0] is not self.binary:
+            self.sidecar = (self.binary, self.sha256(self.binary))
+        return self.sidecar[1]
+
+    def probe(self):
+        up = int(time.time() - self.started) if self.pid else None
+        return json.dumps({
+            "binary": {"digest": self.binary_digest(), "size": len(self.binary or b""), "mtime": 0},
+            "deps": {"xdotool": self.deps, "xclip": self.deps},
+            "peer": {"sshpass": True, "cloudflared": True},
+            "releases": sorted(self.releases),
+            "config": {"mcp_config.json": self.sha256(self.files.get("mcp")), "GEMINI.md": self.sha256(self.files.get("rules"))},
+            "env": "env" in self.files,
+            "process": {"pid": self.pid or None, "uptime": up},
+            "disk_free_kb": 10 * 1024 * 1024,
+            "arch": "aarch64",
+            "release": "ubuntu-jammy",
+            "env_digest": self.sha256(self.files.get("env")),
+            "templates": dict(self.templates),
+        })
+
+    def apply_delta(self, payload):
+        data = zlib.decompress(payload)
+        out, i = [], 0
+        while i < len(data):
+            op, n = data[i:i + 1], struct.unpack(">I", data[i + 1:i + 5])[0]
+            i += 5
+            if op == b"C":
+                out.append(self.binary[n * m.DELTA_BLOCK_SIZE:(n + 1) * m.DELTA_BLOCK_SIZE])
+            else:
+                out.append(data[i:i + n])
+                i += n
+        self.binary = b"".join(out)
+
+    def extract_templates(self, payload, cmd):
+        with tarfile.open(fileobj=io.BytesIO(payload), mode="r:gz") as tar:
+            for member in tar.getmembers():
+                self.templates[member.name] = hashlib.sha256(tar.extractfile(member).read()).hexdigest()
+        if "rm -f --" in cmd:
+            for path in shlex.split(cmd.split("rm -f --", 1)[1]):
+                self.templates.pop(path, None)
+
+    def run(self, cmd, stdin):
+        """Return (exit code, stdout) for a remote command."""
+        with self.lock:
+            if cmd == m.PROBE_SCRIPT:
+                return 0, self.probe() + "\n"
+            if shlex.quote(m.BLOCK_SIG_SCRIPT) in cmd:
+                blocks = [self.binary[i:i + m.DELTA_BLOCK_SIZE] for i in range(0, len(self.binary or b""), m.DELTA_BLOCK_SIZE)]
+                return 0, "\n".join(hashlib.sha256(b).hexdigest() for b in blocks) + "\n"
+            if shlex.quote(m.DELTA_APPLY_SCRIPT) in cmd:
+                self.apply_delta(stdin)
+                return 0, ""
+            if cmd.startswith(f"mkdir -p {m.REMOTE_RELEASES}"):
+                return self.receive(stdin, cmd)
+            if cmd.startswith(f'[ "$(sha256sum {m.REMOTE_RELEASES}/'):
+                digest = cmd.split(m.REMOTE_RELEASES + "/", 1)[1].split()[0]
+                if digest not in self.releases:
+                    return 1, ""
+                self.binary = self.releases[digest]
+                return 0, ""
+            if cmd.startswith("gzip -dc"):
+                self.binary = gzip.decompress(stdin)
+                return 0, ""
+            if "tar -xzf" in cmd:
+                self.extract_templates(stdin, cmd)
+                return 0, ""
+            if cmd.endswith("&& tar -xf -"):
+                self.extract_config(stdin)
+                return 0, ""
+            if cmd == m.CONFIG_CHECK_SCRIPT:
+                lines = ["running" if self.pid else "stopped"]
+                lines += [f"{self.sha256(self.files[CONFIG_KEYS[key]])}  {path}"
+                          for key, path in m.CONFIG_FILES.items() if CONFIG_KEYS[key] in self.files]
+                return 0, "\n".join(lines) + "\n"
+            if "pkill" in cmd and "nohup" in cmd:
+                self.pid += 1
+                self.started = time.time()
+                return 0, ""
+            if "etimes" in cmd:
+                return 0, f"{self.pid} {int(time.time() - self.started)} 1\n"
+            if cmd.startswith("pgrep"):
+                return (0, f"{self.pid}\n") if self.pid else (1, "")
+            if cmd.startswith("dpkg-query"):
+                return 0, "".join(f"{p} 1.0 installed\n" for p in m.DEPS_PACKAGES if self.deps and p in cmd)
+            if "apt-cache depends" in cmd:
+                return 100, ""  # No mirror: bundles can't be built, apt-get fallback
+            if "apt-get install" in cmd:
+                self.deps = True
+                return 0, ""
+            if cmd.startswith("uname -m"):
+                return 0, "aarch64\n"
+            if cmd == m.OS_RELEASE_CMD:
+                return 0, "ubuntu-jammy\n"
+            return 0, ""
+
+    def receive(self, stdin, cmd):
+        data = gzip.decompress(stdin) if "gzip -dc" in cmd else stdin
+        digest = hashlib.sha256(data).hexdigest()
+        if f"= {digest} ]" not in cmd:
+            return 1, ""
+        self.releases[digest] = data
+        return 0, ""
+
+    def extract_config(self, payload):
+        paths = {path: CONFIG_KEYS[key] for key, path in m.CONFIG_FILES.items()}
+        with tarfile.open(fileobj=io.BytesIO(payload), mode="r:") as tar:
+            for member in tar.getmembers():
+                self.files[paths[member.name]] = tar.extractfile(member).read()
+
+
+
+class FakeFleet:
+    def __init__(self, latency, handshake, connect_timeout=0.5):
+        self.latency = latency
+        self.handshake = handshake
+        self.connect_timeout = connect_timeout
+        self.hosts = {}
+        self.dead = set()
+
+    def host(self, target):
+        name = target.split("@", 1)[1].split(":", 1)[0]
+        if name not in self.hosts:
+            self.hosts[name] = FakeHost(name)
+        return self.hosts[name]
+
+    def run(self, argv, input=None, **kwargs):
+        """Stand-in for subprocess.run on sshpass/ssh command lines."""
+        COUNTERS.add(spawns=1)
+        args = list(argv)
+        if args[0] == "sshpass":
+            args = args[2:] if args[1] == "-e" else args[3:]
+        tool, args = args[0], args[1:]
+        if tool != "ssh":
+            # Local tooling (dpkg, apt-get bundle builds) is not emulated
+            return subprocess.CompletedProcess(argv, 127, b"", b"not emulated")
+        opts, flags, plain = {}, set(), []
+        i = 0
+        while i < len(args):
+            if args[i] in ("-o", "-O"):
+                if args[i] == "-o":
+                    key, _, value = args[i + 1].partition("=")
+                    opts[key] = value
+                flags.add(args[i])
+                i += 2
+            elif args[i].startswith("-") and not plain:
+                flags.add(args[i])
+                i += 1
+            else:
+                plain.append(args[i])
+                i += 1
+        stdin = input or b""
+        control = opts.get("ControlPath")
+        if plain and plain[0].split("@", 1)[-1].split(":", 1)[0] in self.dead:
+            time.sleep(self.connect_timeout)
+            return subprocess.CompletedProcess(argv, 255, b"", b"ssh: connect to host: Connection timed out")
+
+        if tool == "ssh" and "-O" in flags:
+            return subprocess.CompletedProcess(argv, 0, b"", b"")
+        if tool == "ssh" and "-N" in flags:
+            # Master connection: full handshake, then the control socket exists
+            time.sleep(self.handshake)
+            COUNTERS.add(handshakes=1)
+            open(control, "w").close()
+            return subprocess.CompletedProcess(argv, 0, b"", b"")
+
+        multiplexed = control and os.path.exists(control)
+        time.sleep(self.latency if multiplexed else self.latency + self.handshake)
+        if not multiplexed:
+            COUNTERS.add(handshakes=1)
+        COUNTERS.add(round_trips=1)
+
+        target, cmd = plain[0], plain[1]
+        if cmd.startswith("timeout "):
+            cmd = shlex.split(cmd)[6]  # m.bounded_cmd: timeout -k GRACE SECS bash -c CMD
+        if cmd.startswith("read -r SSHPASS"):
+            return self.relay(argv, target, cmd)
+        code, out = self.host(target).run(cmd, stdin)
+        out = out.encode()
+        COUNTERS.add(bytes_up=len(stdin) + len(cmd), bytes_down=len(out))
+        return subprocess.CompletedProcess(argv, code, out, b"")
+
+
+    def relay(self, argv, source, cmd):
+        """Peer -> peer copy started on source: a fresh ssh connection from the source to the target."""
+        time.sleep(self.latency + self.handshake)
+        digest = cmd.split(f"< {m.REMOTE_RELEASES}/", 1)[1].split(";")[0].strip()
+        target = cmd.split(f"{m.SSH_USER}@", 1)[1].split()[0]
+        data = self.host(source).releases.get(digest)
+        if data is None:
+            return subprocess.CompletedProcess(argv, 1, b"", b"no such release")
+        self.host(f"{m.SSH_USER}@{target}").releases[digest] = data
+        COUNTERS.add(bytes_peer=len(data))
+        return subprocess.CompletedProcess(argv, 0, b"", b"")
+
+
+# ---------------------------------------------------------------------------
+# Fake HTTP APIs (GitHub, Cloudflare, Telegram)
+# ---------------------------------------------------------------------------
+
+class FakeAPI(http.server.BaseHTTPRequestHandler):
+    latency = 0.0
+    agents = {}
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, code, body=b"", headers=None):
+        self.send_response(code)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        COUNTERS.add(bytes_down=len(body))
+
+    def json_reply(self, data):
+        body = json.dumps(data).encode()
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if self.headers.get("If-None-Match") == etag:
+            return self.reply(304, headers={"ETag": etag})
+        self.reply(200, body, {"ETag": etag, "Content-Type": "application/json"})
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        COUNTERS.add(http_requests=1)
+        base = f"http://127.0.0.1:{self.server.server_port}"
+        if self.path.endswith("/releases/latest"):
+            return self.json_reply({"tag_name": "v2", "assets": [{
+                "name": "gravity-agent-linux-arm64", "url": f"{base}/asset/arm64", "size": len(NEW_BINARY),
+                "digest": "sha256:" + hashlib.sha256(NEW_BINARY).hexdigest()}]})
+        if self.path.startswith("/asset/"):
+            start = int(self.headers["Range"].split("=")[1].rstrip("-")) if self.headers.get("Range") else 0
+            return self.reply(206 if start else 200, NEW_BINARY[start:])
+        if "/contents/" in self.path:
+            import base64
+            content = base64.b64encode(json.dumps({"agents": self.agents}).encode()).decode()
+            return self.json_reply({"content": content})
+        if "/dns_records" in self.path:
+            zone = self.path.split("/zones/")[1].split("/")[0]
+            suffix = "555606.xyz" if zone == "zone-b" else "hhwpxh.com"
+            result = [{"name": info["ssh_host"], "content": f"{i:08x}-0000-0000-0000-000000000000.cfargotunnel.com"}
+                      for i, info in enumerate(self.agents.values()) if info["ssh_host"].endswith(suffix)]
+            return self.json_reply({"success": True, "result": result, "result_info": {"total_pages": 1}})
+        self.reply(404)
+
+    def do_POST(self):
+        time.sleep(self.latency)
+        COUNTERS.add(http_requests=1)
+        length = int(self.headers.get("Content-Length", 0))
+        COUNTERS.add(bytes_up=len(self.rfile.read(length)))
+        self.reply(200, b'{"ok": true}')
+
+
+def start_api(latency):
+    FakeAPI.latency = latency
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FakeAPI)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}"
+    m.GITHUB_API = base
+    m.RELEASES_URL = f"{base}/repos/suwei8/GravityBridge-Go/releases/latest"
+    m.CF_API = base
+    m.TELEGRAM_API = base
+    return server
+
+
+# ---------------------------------------------------------------------------
+# Scenarios
+# ---------------------------------------------------------------------------
+
+def reset_run_state():
+    """Forget everything maintenance.py keeps in memory for a single run (on-disk caches stay)."""
+    m.close_sessions()
+    m._SESSIONS.clear()
+    m.reset_run_state()
+    os.makedirs(os.environ["SSH_CONTROL_DIR"], exist_ok=True)
+
+
+def make_agents(n):
+    return {f"agent-{i:04d}": {
+        "ssh_host": f"vm{i:04d}.{'555606.xyz' if i % 2 else 'hhwpxh.com'}",
+        "url": f"https://agent{i:04d}.example.com",
+    } for i in range(n)}
+
+
+def scenarios(args):
+    def run_args(**kw):
+        base = dict(tunnel_id=None, full_scan=False, fresh_window=3600, concurrency=args.concurrency,
+                    canary=1, wave_size=0, unhold=None, target=None, distribution=args.distribution,
+                    plan_only=False)
+        base.update(kw)
+        return types.SimpleNamespace(**base)
+
+    def check(agents):
+        m.check_deploy(agents, args.concurrency)
+
+    def check_and_fix(agents):
+        a = run_args()
+        m.plan_fleet(agents, a)
+        m.rollout(agents, lambda name, info: m.ensure_agent(name, agents, a), a)
+
+    def deploy(agents):
+        a = run_args()
+        m.rollout(agents, lambda name, info: m.deploy_agent(name, agents, a), a)
+
+    def restart(agents):
+        m.restart_services(agents, args.concurrency)
+
+    return [
+        ("check", check),
+        ("check_and_fix (cold)", check_and_fix),
+        ("check_and_fix (warm)", check_and_fix),
+        ("deploy", deploy),
+        ("restart", restart),
+    ]
+
+
+def run_size(n, args, fleet):
+    agents = make_agents(n)
+    FakeAPI.agents = agents
+    fleet.dead = {info["ssh_host"] for info in list(agents.values())[:args.dead]}
+    if os.path.exists(m.STATE_DB):
+        os.remove(m.STATE_DB)
+        m._STATE_READY = False
+    rows = []
+    for label, fn in scenarios(args):
+        reset_run_state()
+        COUNTERS.reset()
+        devnull = open(os.devnull, "w")
+        real_stdout = sys.stdout
+        sys.stdout = devnull
+        start = time.time()
+        try:
+            m.get_agents()
+            fn(agents)
+            m._NOTIFIER.flush()
+        finally:
+            elapsed = time.time() - start
+            sys.stdout = real_stdout
+            devnull.close()
+        rows.append((n, label, elapsed, COUNTERS.round_trips, COUNTERS.handshakes, COUNTERS.http_requests,
+                     COUNTERS.bytes_up, COUNTERS.bytes_down, COUNTERS.bytes_peer, COUNTERS.spawns))
+        print(f"{n:>6}  {label:<22} {elapsed:>8.2f}s {COUNTERS.round_trips:>8} {COUNTERS.handshakes:>6} "
+              f"{COUNTERS.http_requests:>6} {COUNTERS.bytes_up / 1024:>10.0f} {COUNTERS.bytes_down / 1024:>10.0f} "
+              f"{COUNTERS.bytes_peer / 1024:>10.0f} {COUNTERS.spawns:>7}", flush=True)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="1,10,100,1000", help="Comma-separated fleet sizes (default: 1,10,100,1000)")
+    parser.add_argument("--latency", type=float, default=0.02, help="Per round-trip latency in seconds (ssh and http)")
+    parser.add_argument("--handshake", type=float, default=0.2, help="Extra latency of a new ssh connection in seconds")
+    parser.add_argument("--concurrency", type=int, default=m.MAX_WORKERS, help="Agents processed in parallel")
+    parser.add_argument("--dead", type=int, default=0, help="Agents per fleet size whose host never answers")
+    parser.add_argument("--connect-timeout", type=float, default=0.5, help="Seconds a connection to a dead host hangs")
+    parser.add_argument("--distribution", choices=["direct", "tree"], default="direct",
+                        help="Artifact delivery mode passed to check_and_fix/deploy")
+    parser.add_argument("--json", help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    fleet = FakeFleet(args.latency, args.handshake, args.connect_timeout)
+    m.subprocess.run = fleet.run
+    m.READY_POLL_INITIAL = 0.01
+    start_api(args.latency)
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    print(f"latency={args.latency}s handshake={args.handshake}s concurrency={args.concurrency} "
+          f"distribution={args.distribution} dead={args.dead}")
+    print(f"{'agents':>6}  {'action':<22} {'wall':>9} {'ssh rtt':>8} {'hshk':>6} {'http':>6} "
+          f"{'up KB':>10} {'down KB':>10} {'peer KB':>10} {'spawns':>7}")
+    results = []
+    for n in (int(x) for x in args.sizes.split(",")):
+        fleet.hosts.clear()
+        results += run_size(n, args, fleet)
+
+    if args.json:
+        keys = ("agents", "action", "wall_seconds", "ssh_round_trips", "ssh_handshakes", "http_requests",
+                "bytes_up", "bytes_down", "bytes_peer", "process_spawns")
+        with open(args.json, "w") as f:
+            json.dump([dict(zip(keys, row)) for row in results], f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,13 +6,41 @@ import argparse
 import time
 import shutil
 import hashlib
+import contextlib
+import functools
+import io
+import sqlite3
+import tarfile
+import gzip
+import shlex
+import struct
+import zlib
+import math
+import random
+import sys
+import atexit
+import tempfile
+import calendar
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 
-def get_file_md5(path):
-    hash_md5 = hashlib.md5()
-    with open(path, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+# Fingerprints
+# sha256 everywhere; a local file is read (in 1 MB chunks) once per (path, size, mtime, inode).
+_FINGERPRINTS = {}
+_FINGERPRINT_LOCK = threading.Lock()
+
+def file_digest(path):
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_size, st.st_mtime_ns, st.st_ino)
+    with _FINGERPRINT_LOCK:
+        if key not in _FINGERPRINTS:
+            digest = hashlib.sha256()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+            _FINGERPRINTS[key] = digest.hexdigest()
+        return _FINGERPRINTS[key]
 
 
 # Secrets from Environment
@@ -36,47 +64,444 @@ CF_API_KEY_B = os.getenv("CF_API_KEY_555606", "").strip()
 CF_ACCOUNT_ID_B = os.getenv("CF_ACCOUNT_ID_555606", "").strip()
 CF_ZONE_ID_B = os.getenv("CF_ZONE_ID_555606", "").strip()
 
+# API Endpoints (overridable for local stand-ins, see benchmark.py)
+GITHUB_API = os.getenv("GITHUB_API_URL", "https://api.github.com").rstrip("/")
+CF_API = os.getenv("CF_API_URL", "https://api.cloudflare.com/client/v4").rstrip("/")
+TELEGRAM_API = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org").rstrip("/")
+
+# Local Cache (release artifacts, tunnel index, HTTP responses)
+CACHE_DIR = os.getenv("GRAVITY_CACHE_DIR", "").strip() or os.path.expanduser("~/.cache/gravitybridge")
+
+# Fleet Execution
+MAX_WORKERS = int(os.getenv("MAINT_CONCURRENCY", "8") or 8)
+
+class HostOutput:
+    """stdout proxy: prints from a worker thread are buffered per host instead of interleaving."""
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def write(self, text):
+        buf = getattr(self.local, "buf", None)
+        if buf is None:
+            return self.stream.write(text)
+        buf.append(text)
+        return len(text)
+
+    def flush(self):
+        if getattr(self.local, "buf", None) is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+def _host_output():
+    if not isinstance(sys.stdout, HostOutput):
+        sys.stdout = HostOutput(sys.stdout)
+    return sys.stdout
+
+def run_parallel(agents, fn, max_workers=None):
+    """Run fn(name, info) -> (ok, detail) for every agent concurrently.
+
+    Each host's output is captured and printed as one block when it finishes,
+    and an exception on one host is recorded as its failure without affecting the others.
+    """
+    out = _host_output()
+    workers = max(1, min(max_workers or MAX_WORKERS, len(agents) or 1))
+    results = {}
+
+    def worker(name, info):
+        out.local.buf = []
+        _CTX.agent = name
+        host = info.get("ssh_host") if isinstance(info, dict) else None
+        start = time.time()
+        _CTX.deadline = start + HOST_BUDGET if HOST_BUDGET else None
+        try:
+            budget = remaining_budget()
+            if host in UNREACHABLE:
+                ok, detail = False, f"skipped, unreachable: {UNREACHABLE[host]}"
+            elif budget is not None and budget <= 0:
+                ok, detail = False, "skipped, run deadline reached"
+            else:
+                ok, detail = fn(name, info)
+                if not ok and host in UNREACHABLE:
+                    detail = f"unreachable: {UNREACHABLE[host]}"
+        except Exception as e:
+            print(f"❌ {name}: Unhandled error: {redact_secrets(e)}")
+            ok, detail = False, f"error: {redact_secrets(e)}"
+        finally:
+            lines = "".join(out.local.buf)
+            out.local.buf = None
+            _CTX.agent = None
+            _CTX.deadline = None
+        elapsed = time.time() - start
+        if lines:  # Hosts with nothing to report (e.g. planning) stay quiet
+            with out.lock:
+                out.stream.write(f"\n===== {name} ({elapsed:.1f}s) =====\n{lines}")
+                out.stream.flush()
+        return {"name": name, "ok": ok, "detail": detail, "seconds": elapsed}
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(worker, name, info) for name, info in agents.items()]
+        for fut in as_completed(futures):
+            res = fut.result()
+            results[res["name"]] = res
+    return [results[name] for name in agents if name in results]
+
+def print_summary(title, results):
+    if not results:
+        return
+    width = max(len("Agent"), *(len(r["name"]) for r in results))
+    print(f"\n📋 {title} Summary")
+    print(f"{'Agent':<{width}}  {'Status':<6}  {'Time':>7}  Detail")
+    print(f"{'-' * width}  {'-' * 6}  {'-' * 7}  {'-' * 30}")
+    for r in results:
+        status = "OK" if r["ok"] else "FAIL"
+        print(f"{r['name']:<{width}}  {status:<6}  {r['seconds']:>6.1f}s  {r['detail']}")
+    failed = sum(1 for r in results if not r["ok"])
+    print(f"Total: {len(results)}, OK: {len(results) - failed}, Failed: {failed}")
+
 def redact_secrets(text):
     # ... (existing redaction code) ...
     if not text: return text
-    import re
-    text = re.sub(r'token=[^&\s]+', 'token=***', str(text))
-    if SSH_PASS: text = text.replace(SSH_PASS, '***')
+    # KEY=value pairs with secret-looking names (token=, GITHUB_TOKEN=, CF_API_KEY=, SSH_PASSWORD=, ...)
+    text = re.sub(r'(?i)\b(\w*(?:token|key|pass|secret)\w*)=[^&\s]+', r'\1=***', str(text))
+    for secret in (SSH_PASS, GH_TOKEN, TG_TOKEN, CF_API_KEY, CF_API_KEY_B):
+        if secret: text = text.replace(secret, '***')
     return text
 
+# Run Metrics
+# Every instrumented phase becomes a span (duration, agent, ok/exit code, bytes). At the end
+# of the run spans are written to events-<run>.jsonl and summarised in a Prometheus textfile.
+METRICS_DIR = os.getenv("MAINT_METRICS_DIR", "").strip() or os.path.join(CACHE_DIR, "metrics")
+METRICS_KEEP = int(os.getenv("MAINT_METRICS_KEEP", "50") or 0)  # event files of past runs kept (0 = all)
+RUN_ID = time.strftime("%Y%m%dT%H%M%S") + f"-{os.getpid()}"
+RUN_STARTED = time.time()
+
+_SPANS = []
+_SPANS_LOCK = threading.Lock()
+_CTX = threading.local()  # .agent is set by run_parallel workers, .stack holds open spans
+
+@contextlib.contextmanager
+def span(phase, **attrs):
+    stack = _CTX.__dict__.setdefault("stack", [])
+    rec = {"run": RUN_ID, "phase": phase, "agent": getattr(_CTX, "agent", None), "ts": round(time.time(), 3), **attrs}
+    stack.append(rec)
+    start = time.perf_counter()
+    try:
+        yield rec
+        rec.setdefault("ok", True)
+    except Exception as e:
+        rec["ok"] = False
+        rec["error"] = redact_secrets(e)[:200]
+        raise
+    finally:
+        stack.pop()
+        rec["duration"] = round(time.perf_counter() - start, 4)
+        with _SPANS_LOCK:
+            _SPANS.append(rec)
+
+def span_attr(**attrs):
+    """Attach attributes (bytes, mode, ...) to the innermost open span of this thread."""
+    stack = getattr(_CTX, "stack", None)
+    if stack:
+        stack[-1].update(attrs)
+
+def traced(phase):
+    """Record each call as a span; ok/exit_code are derived from the return value."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(phase) as rec:
+                result = fn(*args, **kwargs)
+                if isinstance(result, subprocess.CompletedProcess):
+                    rec["exit_code"] = result.returncode
+                    rec.setdefault("ok", result.returncode == 0)
+                elif isinstance(result, tuple):
+                    rec.setdefault("ok", bool(result[0]))
+                else:
+                    rec.setdefault("ok", result is not None and result is not False)
+                return result
+        return wrapper
+    return decorator
+
+def _quantile(values, q):
+    """Nearest-rank quantile: the smallest value with at least q of the samples at or below it."""
+    values = sorted(values)
+    return values[max(0, math.ceil(q * len(values)) - 1)]
+
+def phase_stats():
+    with _SPANS_LOCK:
+        spans = list(_SPANS)
+    phases = {}
+    for rec in spans:
+        phases.setdefault(rec["phase"], []).append(rec)
+    return {
+        phase: {
+            "count": len(recs),
+            "sum": sum(r["duration"] for r in recs),
+            "p50": _quantile([r["duration"] for r in recs], 0.5),
+            "p95": _quantile([r["duration"] for r in recs], 0.95),
+            "failures": sum(1 for r in recs if r.get("ok") is False),
+            "bytes": sum(r.get("bytes", 0) for r in recs),
+        } for phase, recs in phases.items()
+    }
+
+def write_metrics(action):
+    """Write this run's spans to events-<run>.jsonl and the Prometheus textfile."""
+    stats = phase_stats()
+    if not stats:
+        return
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    with _SPANS_LOCK:
+        spans = list(_SPANS)
+    with open(os.path.join(METRICS_DIR, f"events-{RUN_ID}.jsonl"), "w") as f:
+        for rec in spans:
+            f.write(json.dumps({"action": action, **rec}) + "\n")
+    if METRICS_KEEP:
+        runs = sorted((e for e in os.scandir(METRICS_DIR) if e.name.startswith("events-") and e.name.endswith(".jsonl")),
+                      key=lambda e: e.stat().st_mtime, reverse=True)
+        for old in runs[METRICS_KEEP:]:
+            os.remove(old.path)
+
+    lines = [
+        "# HELP gravitybridge_phase_duration_seconds Duration of maintenance phases in the last run.",
+        "# TYPE gravitybridge_phase_duration_seconds summary",
+    ]
+    for phase, st in sorted(stats.items()):
+        labels = f'action="{action}",phase="{phase}"'
+        lines += [
+            f'gravitybridge_phase_duration_seconds{{{labels},quantile="0.5"}} {st["p50"]}',
+            f'gravitybridge_phase_duration_seconds{{{labels},quantile="0.95"}} {st["p95"]}',
+            f"gravitybridge_phase_duration_seconds_sum{{{labels}}} {st['sum']:.4f}",
+            f"gravitybridge_phase_duration_seconds_count{{{labels}}} {st['count']}",
+        ]
+    lines += ["# HELP gravitybridge_phase_failures Failed spans per phase in the last run.",
+              "# TYPE gravitybridge_phase_failures gauge"]
+    lines += [f'gravitybridge_phase_failures{{action="{action}",phase="{p}"}} {st["failures"]}' for p, st in sorted(stats.items())]
+    lines += ["# HELP gravitybridge_phase_bytes Bytes transferred per phase in the last run.",
+              "# TYPE gravitybridge_phase_bytes gauge"]
+    lines += [f'gravitybridge_phase_bytes{{action="{action}",phase="{p}"}} {st["bytes"]}' for p, st in sorted(stats.items()) if st["bytes"]]
+    lines += ["# HELP gravitybridge_run_duration_seconds Wall-clock time of the last run.",
+              "# TYPE gravitybridge_run_duration_seconds gauge",
+              f'gravitybridge_run_duration_seconds{{action="{action}"}} {time.time() - RUN_STARTED:.3f}',
+              "# HELP gravitybridge_run_timestamp_seconds Start time of the last run.",
+              "# TYPE gravitybridge_run_timestamp_seconds gauge",
+              f'gravitybridge_run_timestamp_seconds{{action="{action}"}} {RUN_STARTED:.0f}']
+    path = os.path.join(METRICS_DIR, "gravitybridge.prom")
+    with open(path + ".tmp", "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(path + ".tmp", path)
+
+def print_phase_stats():
+    stats = phase_stats()
+    if not stats:
+        return
+    print("\n⏱️ Phase Timings")
+    print(f"{'Phase':<16} {'Count':>6} {'p50':>8} {'p95':>8} {'Fail':>5}")
+    for phase, st in sorted(stats.items(), key=lambda kv: -kv[1]["sum"]):
+        print(f"{phase:<16} {st['count']:>6} {st['p50']:>7.2f}s {st['p95']:>7.2f}s {st['failures']:>5}")
+
+# HTTP Client
+# One keep-alive session per endpoint class, each with its own timeout and retry budget.
+HTTP_ENDPOINTS = {
+    # kind: (timeout seconds, retries)
+    "github": (15, 3),
+    "download": (60, 3),
+    "agents": (15, 3),
+    "cloudflare": (10, 2),
+    "telegram": (5, 1),
+    "health": (5, 0),
+}
+
+_HTTP_SESSIONS = {}
+_HTTP_LOCK = threading.Lock()
+
+def http_session(kind):
+    with _HTTP_LOCK:
+        if kind not in _HTTP_SESSIONS:
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+            _, retries = HTTP_ENDPOINTS[kind]
+            retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504))
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(MAX_WORKERS, 4), max_retries=retry)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _HTTP_SESSIONS[kind] = session
+        return _HTTP_SESSIONS[kind]
+
+def http_request(kind, method, url, **kwargs):
+    kwargs.setdefault("timeout", HTTP_ENDPOINTS[kind][0])
+    return http_session(kind).request(method, url, **kwargs)
+
+def cached_get_json(kind, url, headers=None):
+    """GET a JSON document, revalidating a local copy with ETag/Last-Modified.
+
+    Returns (data, status) where status is 200 for a fresh payload and 304 when the
+    cached copy was still valid. Raises on HTTP or network errors.
+    """
+    cache_dir = os.path.join(CACHE_DIR, "http")
+    path = os.path.join(cache_dir, hashlib.sha1(url.encode()).hexdigest() + ".json")
+    try:
+        with open(path) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        cached = None
+
+    headers = dict(headers or {})
+    if cached:
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+    resp = http_request(kind, "GET", url, headers=headers)
+    if resp.status_code == 304 and cached:
+        return cached["data"], 304
+    resp.raise_for_status()
+    data = resp.json()
+    if resp.headers.get("ETag") or resp.headers.get("Last-Modified"):
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            json.dump({"etag": resp.headers.get("ETag"), "last_modified": resp.headers.get("Last-Modified"), "data": data}, f)
+        os.replace(path + ".tmp", path)
+    return data, 200
+
+# Telegram Notifications
+# Events are queued and delivered by a background thread: events arriving within
+# TG_COALESCE_SECONDS are merged into one digest, split to Telegram's size limit and
+# sent no faster than TG_MIN_INTERVAL. Fleet operations never wait on Telegram.
+TG_MAX_LEN = 4096
+TG_MIN_INTERVAL = 1.1
+TG_COALESCE_SECONDS = float(os.getenv("TG_COALESCE_SECONDS", "10") or 10)
+TG_FLUSH_TIMEOUT = 30
+
+def _split_message(text, limit=TG_MAX_LEN):
+    """Split on line boundaries so each chunk fits in one message."""
+    chunks, current = [], ""
+    for line in text.split("\n"):
+        while len(line) > limit:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(line[:limit])
+            line = line[limit:]
+        candidate = f"{current}\n{line}" if current else line
+        if len(candidate) > limit:
+            chunks.append(current)
+            candidate = line
+        current = candidate
+    if current:
+        chunks.append(current)
+    return chunks
+
+class TelegramNotifier:
+    def __init__(self):
+        self.events = []
+        self.cond = threading.Condition()
+        self.closing = False
+        self.thread = None
+        self.last_sent = 0.0
+
+    def notify(self, text):
+        with self.cond:
+            self.events.append(text)
+            if self.thread is None or not self.thread.is_alive():
+                # First event, or the previous worker was drained by flush()
+                self.closing = False
+                self.thread = threading.Thread(target=self._run, name="telegram", daemon=True)
+                self.thread.start()
+            self.cond.notify()
+
+    def flush(self, timeout=TG_FLUSH_TIMEOUT):
+        with self.cond:
+            if self.thread is None:
+                return
+            self.closing = True
+            self.cond.notify()
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            print("⚠️ Telegram flush timed out, some notifications were not delivered.")
+            return
+        with self.cond:
+            # Drained: the next notify() starts a fresh worker (the daemon flushes every cycle)
+            self.closing, self.thread = False, None
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.events and not self.closing:
+                    self.cond.wait()
+                if not self.events:
+                    return
+                # Give related events a moment to pile up into one digest
+                deadline = time.time() + TG_COALESCE_SECONDS
+                while not self.closing and time.time() < deadline:
+                    self.cond.wait(deadline - time.time())
+                events, self.events = self.events, []
+            if len(events) == 1:
+                digest = events[0]
+            else:
+                digest = f"🛰 **GravityBridge Digest** ({len(events)} events)\n\n" + "\n\n".join(events)
+            for chunk in _split_message(digest):
+                self._send(chunk)
+
+    def _send(self, text):
+        url = f"{TELEGRAM_API}/bot{TG_TOKEN}/sendMessage"
+        payload = {
+            "chat_id": TG_CHAT_ID,
+            "text": text,
+            "parse_mode": "Markdown"
+        }
+        for _ in range(3):
+            wait = self.last_sent + TG_MIN_INTERVAL - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                resp = http_request("telegram", "POST", url, json=payload)
+                self.last_sent = time.time()
+                if resp.status_code == 429:
+                    retry_after = resp.json().get("parameters", {}).get("retry_after", 5)
+                    time.sleep(min(retry_after, TG_FLUSH_TIMEOUT))
+                    continue
+                if resp.status_code == 400 and "parse_mode" in payload:
+                    # A split can cut through Markdown entities; resend as plain text
+                    payload.pop("parse_mode")
+                    continue
+                return
+            except Exception as e:
+                print(f"⚠️ TG Send failed: {redact_secrets(e)}")
+                return
+
+_NOTIFIER = TelegramNotifier()
+atexit.register(_NOTIFIER.flush)
+
 def send_telegram(text):
     if not TG_TOKEN or not TG_CHAT_ID:
         print(f"⚠️ Telegram (Skip): {text}")
         return
-    
-    url = f"https://api.telegram.org/bot{TG_TOKEN}/sendMessage"
-    payload = {
-        "chat_id": TG_CHAT_ID,
-        "text": text,
-        "parse_mode": "Markdown"
-    }
-    try:
-        requests.post(url, json=payload, timeout=5)
-    except Exception as e:
-        print(f"⚠️ TG Send failed: {e}")
+    _NOTIFIER.notify(text)
 
 def get_agents():
     # Attempt 1: Fetch via GitHub API (Preferred if GH_TOKEN is valid for cross-repo)
     if GH_TOKEN:
         print("Fetching agents via GitHub API...")
-        api_url = "https://api.github.com/repos/suwei8/GravityBridge-Go/contents/.agent/data/agents.json"
+        api_url = f"{GITHUB_API}/repos/suwei8/GravityBridge-Go/contents/.agent/data/agents.json"
         headers = {"Authorization": f"token {GH_TOKEN}", "Accept": "application/vnd.github.v3+json"}
         try:
-            resp = requests.get(api_url, headers=headers)
-            if resp.status_code == 200:
-                import base64
-                content = base64.b64decode(resp.json()["content"]).decode("utf-8")
-                data = json.loads(content)
-                return data.get("agents", {})
-            elif resp.status_code == 404:
+            data, status = cached_get_json("agents", api_url, headers)
+            if status == 304:
+                print("✅ agents.json unchanged (cached).")
+            import base64
+            content = base64.b64decode(data["content"]).decode("utf-8")
+            data = json.loads(content)
+            return data.get("agents", {})
+        except requests.HTTPError as e:
+            if e.response.status_code == 404:
                 print("⚠️ API returned 404. Check Repo/Path permissions.")
             else:
-                 print(f"⚠️ API Fetch failed: {resp.status_code} {resp.text}")
+                 print(f"⚠️ API Fetch failed: {e.response.status_code} {e.response.text}")
         except Exception as e:
             print(f"⚠️ API Fetch Exception: {redact_secrets(e)}")
 
@@ -98,9 +523,7 @@ def get_agents():
         safe_url = redact_secrets(AGENTS_JSON_URL)
         print(f"Fetching agents from {safe_url}...")
         try:
-            resp = requests.get(AGENTS_JSON_URL)
-            resp.raise_for_status()
-            data = resp.json()
+            data, _ = cached_get_json("agents", AGENTS_JSON_URL)
             return data.get("agents", {})
         except Exception as e:
             msg = f"❌ **GravityBridge Alert**\nFailed to fetch `agents.json`: {redact_secrets(e)}"
@@ -112,27 +535,397 @@ def get_agents():
     return {}
 
 def get_latest_version():
-    url = "https://api.github.com/repos/suwei8/GravityBridge-Go/releases/latest"
-    headers = {"Authorization": f"token {GH_TOKEN}"} if GH_TOKEN else {}
+    # Shares the (conditional) release lookup with the artifact cache
+    return refresh_release_index().get("latest")
+
+# SSH Transports
+# run_ssh/run_ssh_stream go through a pluggable backend (files travel as stdin streams of run_ssh):
+#   subprocess - sshpass + OpenSSH, one ControlMaster connection per host (default)
+#   asyncssh   - in-process client: one connection per host, commands as concurrent channels
+SSH_TRANSPORT = os.getenv("SSH_TRANSPORT", "subprocess").strip() or "subprocess"
+SSH_CONTROL_DIR = os.getenv("SSH_CONTROL_DIR", "").strip()
+SSH_CONTROL_PERSIST = os.getenv("SSH_CONTROL_PERSIST", "600").strip()
+SSH_CONNECT_TIMEOUT = int(os.getenv("SSH_CONNECT_TIMEOUT", "10") or 10)
+
+_CONTROL_DIR_LOCK = threading.Lock()
+
+def _control_path(host):
+    global SSH_CONTROL_DIR
+    with _CONTROL_DIR_LOCK:  # Workers connecting at once must agree on one directory
+        if not SSH_CONTROL_DIR:
+            SSH_CONTROL_DIR = tempfile.mkdtemp(prefix="gb-ssh-")
+    # Unix socket paths are limited to ~104 chars, so don't embed the hostname
+    key = hashlib.md5(f"{SSH_USER}@{host}".encode()).hexdigest()[:16]
+    return os.path.join(SSH_CONTROL_DIR, key)
+
+def ssh_opts(host):
+    return [
+        "-o", "StrictHostKeyChecking=no",
+        "-o", f"ConnectTimeout={SSH_CONNECT_TIMEOUT}",
+        "-o", f"ControlPath={_control_path(host)}",
+    ]
+
+class SubprocessTransport:
+    """sshpass/ssh processes multiplexed over an OpenSSH ControlMaster per host."""
+    name = "subprocess"
+
+    def _spawn(self, argv, timeout=None, **kwargs):
+        # sshpass -e reads the password from the environment instead of the command line
+        env = dict(os.environ, SSHPASS=SSH_PASS or "")
+        try:
+            return subprocess.run(["sshpass", "-e", *argv], check=False, env=env, timeout=timeout,
+                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs)
+        except subprocess.TimeoutExpired as e:
+            # The client was killed; the remote side is bounded by its own `timeout` (see bounded_cmd)
+            return subprocess.CompletedProcess(e.cmd, 124, e.stdout or b"", b"timed out")
+
+    def connect(self, host):
+        ret = self._spawn(["ssh", *ssh_opts(host),
+                           "-o", "ControlMaster=yes",
+                           "-o", f"ControlPersist={SSH_CONTROL_PERSIST}",
+                           "-N", "-f",
+                           f"{SSH_USER}@{host}"])
+        if ret.returncode == 0 and os.path.exists(_control_path(host)):
+            return True, ""
+        return False, f"({ret.returncode}) {ret.stderr.decode('utf-8', errors='replace').strip() or 'no control socket'}"
+
+    def alive(self, host):
+        # ControlPersist expires idle masters, which removes the socket
+        return os.path.exists(_control_path(host))
+
+    def run(self, host, cmd, input=None, timeout=None):
+        return self._spawn(["ssh", *ssh_opts(host), f"{SSH_USER}@{host}", cmd], input=input, timeout=timeout)
+
+    def stream(self, host, cmd, on_line, timeout=None):
+        env = dict(os.environ, SSHPASS=SSH_PASS or "")
+        proc = subprocess.Popen(["sshpass", "-e", "ssh", *ssh_opts(host), f"{SSH_USER}@{host}", cmd], env=env,
+                                stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        killed = []
+        timer = threading.Timer(timeout, lambda: killed.append(proc.kill())) if timeout else None
+        if timer:
+            timer.start()
+        try:
+            with proc.stdout:
+                for line in proc.stdout:
+                    on_line(line)
+            code = proc.wait()
+        finally:
+            if timer:
+                timer.cancel()
+        return 124 if killed else code
+
+    def disconnect(self, host):
+        subprocess.run(["ssh", "-o", f"ControlPath={_control_path(host)}", "-O", "exit", f"{SSH_USER}@{host}"],
+                       check=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def shutdown(self):
+        global SSH_CONTROL_DIR
+        if SSH_CONTROL_DIR and SSH_CONTROL_DIR.startswith(tempfile.gettempdir()):
+            shutil.rmtree(SSH_CONTROL_DIR, ignore_errors=True)
+            SSH_CONTROL_DIR = ""
+
+class AsyncSSHTransport:
+    """In-process asyncssh client driven by a background event loop.
+
+    Worker threads submit coroutines to the loop, so every command to a host is a
+    channel on that host's single connection and no processes are spawned. Host
+    settings (ProxyCommand for cloudflared) still come from ~/.ssh/config.
+    """
+    name = "asyncssh"
+
+    def __init__(self):
+        import asyncio
+        import asyncssh
+        self.asyncio = asyncio
+        self.asyncssh = asyncssh
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="asyncssh", daemon=True)
+        self.thread.start()
+        self.conns = {}  # Shared by the worker threads: guarded by self.lock
+        self.lock = threading.Lock()
+
+    def _call(self, aw):
+        # Some asyncssh calls (create_process) return awaitables that aren't coroutines
+        async def run():
+            return await aw
+        return self.asyncio.run_coroutine_threadsafe(run(), self.loop).result()
+
+    def connect(self, host):
+        async def open_conn():
+            return await self.asyncssh.connect(
+                host, username=SSH_USER, password=SSH_PASS, known_hosts=None, connect_timeout=SSH_CONNECT_TIMEOUT,
+            )
+        try:
+            conn = self._call(open_conn())
+        except (OSError, self.asyncssh.Error) as e:
+            return False, str(e)
+        with self.lock:
+            self.conns[host] = conn
+        return True, ""
+
+    def alive(self, host):
+        with self.lock:
+            return host in self.conns
+
+    def _drop(self, host):
+        with self.lock:
+            return self.conns.pop(host, None)
+
+    def _conn(self, host):
+        with self.lock:
+            conn = self.conns.get(host)
+        if conn is None:
+            ok, err = self.connect(host)
+            if not ok:
+                raise ConnectionError(err)
+            with self.lock:
+                conn = self.conns.get(host)
+            if conn is None:
+                raise ConnectionError("connection closed")
+        return conn
+
+    def run(self, host, cmd, input=None, timeout=None):
+        try:
+            # Without input, stdin is closed like OpenSSH's inherited /dev/null in CI
+            stdin = {"input": input} if input is not None else {"stdin": self.asyncssh.DEVNULL}
+            # Cancelling the wait closes the channel
+            res = self._call(self.asyncio.wait_for(self._conn(host).run(cmd, encoding=None, check=False, **stdin), timeout))
+        except self.asyncio.TimeoutError:
+            return subprocess.CompletedProcess(cmd, 124, b"", b"timed out")
+        except (OSError, self.asyncssh.Error) as e:
+            # Same exit code OpenSSH uses for connection-level failures
+            self._drop(host)
+            return subprocess.CompletedProcess(cmd, 255, b"", str(e).encode())
+        code = res.returncode if res.returncode is not None else 255
+        return subprocess.CompletedProcess(cmd, code, res.stdout or b"", res.stderr or b"")
+
+    def stream(self, host, cmd, on_line, timeout=None):
+        deadline = time.time() + timeout if timeout else None
+        proc = None
+        try:
+            proc = self._call(self._conn(host).create_process(
+                cmd, encoding=None, stdin=self.asyncssh.DEVNULL, stderr=self.asyncssh.STDOUT))
+            # Lines are pulled from the caller's thread so on_line output stays with its host
+            while True:
+                wait = max(deadline - time.time(), 0) if deadline else None
+                line = self._call(self.asyncio.wait_for(proc.stdout.readline(), wait))
+                if not line:
+                    break
+                on_line(line)
+            self._call(proc.wait())
+        except self.asyncio.TimeoutError:
+            if proc is not None:
+                # asyncssh objects belong to the loop thread
+                self.loop.call_soon_threadsafe(proc.close)
+            return 124
+        except (OSError, self.asyncssh.Error) as e:
+            self._drop(host)
+            on_line(f"{e}\n".encode())
+            return 255
+        return proc.returncode if proc.returncode is not None else 255
+
+    def disconnect(self, host):
+        conn = self._drop(host)
+        if conn is None:
+            return
+
+        async def close():
+            conn.close()
+            await conn.wait_closed()
+        try:
+            self._call(close())
+        except (OSError, self.asyncssh.Error):
+            pass
+
+    def shutdown(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+SSH_TRANSPORTS = {"subprocess": SubprocessTransport, "asyncssh": AsyncSSHTransport}
+_TRANSPORT = None
+
+def get_transport():
+    global _TRANSPORT
+    if _TRANSPORT is None:
+        set_transport(SSH_TRANSPORT)
+    return _TRANSPORT
+
+def set_transport(name):
+    """Select the SSH backend for the rest of the run; asyncssh falls back to subprocess if missing."""
+    global _TRANSPORT, SSH_TRANSPORT
+    if name not in SSH_TRANSPORTS:
+        raise ValueError(f"Unknown SSH transport: {name}")
+    if _TRANSPORT is not None:
+        if _TRANSPORT.name == name:
+            return _TRANSPORT
+        close_sessions()
+        _SESSIONS.clear()
     try:
-        resp = requests.get(url, headers=headers)
-        resp.raise_for_status()
-        data = resp.json()
-        return data["tag_name"]
-    except Exception as e:
-        print(f"⚠️ Failed to fetch latest version: {e}")
-        return None
+        _TRANSPORT = SSH_TRANSPORTS[name]()
+    except ImportError:
+        print(f"⚠️ SSH transport '{name}' needs 'pip install {name}', using subprocess")
+        _TRANSPORT = SubprocessTransport()
+    SSH_TRANSPORT = _TRANSPORT.name
+    return _TRANSPORT
+
+# SSH Session Pool
+# One authenticated connection per host; every command and copy in the run reuses it.
+_SESSIONS = {}
+_SESSIONS_LOCK = threading.Lock()
+
+def _session(host):
+    with _SESSIONS_LOCK:
+        if host not in _SESSIONS:
+            _SESSIONS[host] = {
+                "lock": threading.Lock(), "master": False, "connections": 0,
+                "handshake": None, "commands": 0,
+            }
+        return _SESSIONS[host]
+
+@traced("ssh_handshake")
+def open_session(host):
+    """Open (once) the shared connection for host. Returns True if it is reused by later commands."""
+    sess = _session(host)
+    with sess["lock"]:
+        if sess["master"]:
+            if get_transport().alive(host):
+                return True
+            sess["master"], sess["handshake"] = False, None  # Expired while idle (daemon mode), reconnect
+        if sess["handshake"] is not None:
+            # Master failed before; commands fall back to their own connection
+            return False
+        start = time.time()
+        ok, err = get_transport().connect(host)
+        sess["handshake"] = time.time() - start
+        sess["connections"] += 1
+        sess["master"] = ok
+        if not ok:
+            trip_breaker(host, err)
+        return sess["master"]
+
+def close_sessions():
+    if _TRANSPORT is None:
+        return
+    with _SESSIONS_LOCK:
+        hosts = [h for h, sess in _SESSIONS.items() if sess["master"]]
+    for host in hosts:
+        _TRANSPORT.disconnect(host)
+        _SESSIONS[host]["master"] = False
+    _TRANSPORT.shutdown()
+
+atexit.register(close_sessions)
+
+def session_stats():
+    """Per-host connection counts and handshake timing for this run."""
+    with _SESSIONS_LOCK:
+        return {host: {k: v for k, v in sess.items() if k != "lock"} for host, sess in _SESSIONS.items()}
+
+def print_session_stats():
+    stats = session_stats()
+    if not stats:
+        return
+    handshakes = [s["handshake"] for s in stats.values() if s["handshake"] is not None]
+    connections = sum(s["connections"] for s in stats.values())
+    commands = sum(s["commands"] for s in stats.values())
+    print(f"\n🔌 SSH Sessions ({SSH_TRANSPORT}): {len(stats)} hosts, {connections} connections, {commands} commands")
+    if handshakes:
+        print(f"   Handshake: avg {sum(handshakes) / len(handshakes):.2f}s, max {max(handshakes):.2f}s")
+    if UNREACHABLE:
+        print(f"   ⛔ Unreachable: {', '.join(sorted(UNREACHABLE))}")
+
+# Host Budgets & Circuit Breaker
+# Each host gets HOST_BUDGET seconds per fleet pass (one run_parallel worker), and the whole run
+# RUN_DEADLINE seconds if set. Remote commands run under `timeout` with the remaining budget, so
+# the host kills them itself, and the local client is killed shortly after as a backstop. The first
+# connection failure (ssh exit 255) opens the breaker: the host's remaining commands fail fast.
+HOST_BUDGET = float(os.getenv("MAINT_HOST_BUDGET", "600") or 0)    # 0 = unbounded
+RUN_DEADLINE = float(os.getenv("MAINT_RUN_DEADLINE", "0") or 0)    # seconds after RUN_STARTED, 0 = none
+BUDGET_GRACE = 5
+UNREACHABLE = {}  # ssh_host -> reason, for the rest of the run
+
+def remaining_budget():
+    """Seconds left for the current host worker (or the run); None when unbounded."""
+    ends = [d for d in (getattr(_CTX, "deadline", None), RUN_STARTED + RUN_DEADLINE if RUN_DEADLINE else None) if d]
+    return min(ends) - time.time() if ends else None
+
+def bounded_cmd(cmd, budget):
+    if budget is None:
+        return cmd
+    return f"timeout -k {BUDGET_GRACE} {max(1, int(budget))} bash -c {shlex.quote(cmd)}"
+
+def trip_breaker(host, reason):
+    reason = redact_secrets(reason or "").strip()
+    reason = reason.splitlines()[-1][:120] if reason else "connection failed"
+    with _SESSIONS_LOCK:
+        if host in UNREACHABLE:
+            return
+        UNREACHABLE[host] = reason
+    print(f"⛔ {host} unreachable ({reason}), skipping its remaining steps")
+
+def _skip(host):
+    """CompletedProcess for a command that must not run (breaker open / budget spent), else None."""
+    if host in UNREACHABLE:
+        return subprocess.CompletedProcess(host, 255, b"", f"skipped, unreachable: {UNREACHABLE[host]}".encode())
+    budget = remaining_budget()
+    if budget is not None and budget <= 0:
+        return subprocess.CompletedProcess(host, 124, b"", b"skipped, time budget exhausted")
+    return None
+
+def _prepare(host):
+    """Open host's session. Returns a CompletedProcess when the command is skipped instead."""
+    skipped = _skip(host)
+    if skipped is None and not open_session(host):
+        skipped = _skip(host)  # The connection attempt may have opened the breaker
+        if skipped is None:
+            _session(host)["connections"] += 1
+    if skipped is not None:
+        span_attr(skipped=True)
+    return skipped
 
-def run_ssh(host, cmd):
+def _settle(host, ret):
+    if ret.returncode == 255:
+        trip_breaker(host, ret.stderr.decode("utf-8", errors="replace") if isinstance(ret.stderr, bytes) else ret.stderr)
+    return ret
+
+@traced("ssh_command")
+def run_ssh(host, cmd, input=None, text=True):
     # Assumes cloudflared is installed and configured in ~/.ssh/config or via ProxyCommand
-    ssh_cmd = [
-        "sshpass", "-p", SSH_PASS,
-        "ssh", "-o", "StrictHostKeyChecking=no",
-        "-o", "ConnectTimeout=10",
-        f"{SSH_USER}@{host}",
-        cmd
-    ]
-    return subprocess.run(ssh_cmd, check=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    # `input` (bytes) is streamed to the remote command's stdin; output is decoded text unless text=False.
+    ret = _prepare(host)
+    if ret is None:
+        _session(host)["commands"] += 1
+        budget = remaining_budget()
+        ret = _settle(host, get_transport().run(host, bounded_cmd(cmd, budget), input=input,
+                                                timeout=budget and budget + 2 * BUDGET_GRACE))
+    span_attr(bytes=len(input or b"") + len(ret.stdout))
+    if text:
+        ret.stdout = ret.stdout.decode("utf-8", errors="replace")
+        ret.stderr = ret.stderr.decode("utf-8", errors="replace")
+    return ret
+
+@traced("ssh_stream")
+def run_ssh_stream(host, cmd, on_line):
+    """Run cmd on host, calling on_line(text) for each line of combined stdout/stderr as it arrives.
+
+    Returns the exit code.
+    """
+    skipped = _prepare(host)
+    if skipped is not None:
+        on_line(skipped.stderr.decode() + "\n")
+        span_attr(exit_code=skipped.returncode)
+        return skipped.returncode
+    _session(host)["commands"] += 1
+    received = 0
+
+    def feed(line):
+        nonlocal received
+        received += len(line)
+        on_line(line.decode("utf-8", errors="replace"))
+    budget = remaining_budget()
+    code = get_transport().stream(host, bounded_cmd(cmd, budget), feed, timeout=budget and budget + 2 * BUDGET_GRACE)
+    if code == 255:
+        trip_breaker(host, "connection failed")
+    span_attr(bytes=received, exit_code=code)
+    return code
 
 def get_cloudflare_ctx(hostname):
     """Select the correct Cloudflare credentials based on domain."""
@@ -150,409 +943,1764 @@ def get_cloudflare_ctx(hostname):
             "zone_id": CF_ZONE_ID
         }
 
-def resolve_tunnel_id(hostname):
-    """Resolve Cloudflare Tunnel ID for a given hostname CNAME."""
-    ctx = get_cloudflare_ctx(hostname)
-    
-    if not ctx["email"] or not ctx["key"] or not ctx["zone_id"]:
-        print(f"⚠️ Missing Cloudflare Credentials for {hostname}, cannot resolve Tunnel ID automatically.")
-        return None
+# Tunnel Resolution Cache
+# All CNAMEs of a zone are listed in one (paginated) call and indexed hostname -> tunnel ID,
+# persisted with a TTL so repeat deploys resolve without touching the Cloudflare API.
+TUNNEL_CACHE_TTL = int(os.getenv("TUNNEL_CACHE_TTL", str(6 * 3600)) or 0)
+
+_TUNNEL_LOCK = threading.Lock()
+_TUNNEL_INDEX = None
+_TUNNEL_REFRESHED = set()  # Zones already re-listed this run
+
+def _tunnel_cache_path():
+    return os.path.join(CACHE_DIR, "tunnels.json")
+
+def _load_tunnel_index():
+    try:
+        with open(_tunnel_cache_path()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
-    url = f"https://api.cloudflare.com/client/v4/zones/{ctx['zone_id']}/dns_records?name={hostname}&type=CNAME"
+def _save_tunnel_index(index):
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = _tunnel_cache_path()
+    with open(path + ".tmp", "w") as f:
+        json.dump(index, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+def _list_zone_tunnels(ctx):
+    """Map every CNAME hostname in the zone that points at a tunnel to its tunnel ID."""
     headers = {
         "X-Auth-Email": ctx["email"],
         "X-Auth-Key": ctx["key"],
         "Content-Type": "application/json"
     }
-    try:
-        resp = requests.get(url, headers=headers, timeout=10)
+    records, page = {}, 1
+    while True:
+        url = f"{CF_API}/zones/{ctx['zone_id']}/dns_records?type=CNAME&per_page=100&page={page}"
+        resp = http_request("cloudflare", "GET", url, headers=headers)
         resp.raise_for_status()
         data = resp.json()
-        if data["success"] and data["result"]:
-            content = data["result"][0]["content"]
-            import re
-            match = re.search(r"([a-f0-9-]+)\.cfargotunnel\.com", content)
+        if not data.get("success"):
+            raise RuntimeError(f"Cloudflare API error: {data.get('errors')}")
+        for rec in data["result"]:
+            match = re.search(r"([a-f0-9-]+)\.cfargotunnel\.com", rec.get("content", ""))
             if match:
-                return match.group(1)
-    except Exception as e:
-        print(f"❌ Failed to resolve Tunnel ID for {hostname}: {e}")
+                records[rec["name"]] = match.group(1)
+        if page >= (data.get("result_info") or {}).get("total_pages", 1):
+            return records
+        page += 1
+
+@traced("dns_resolve")
+def resolve_tunnel_id(hostname):
+    """Resolve Cloudflare Tunnel ID for a given hostname CNAME."""
+    global _TUNNEL_INDEX
+    ctx = get_cloudflare_ctx(hostname)
+    
+    if not ctx["email"] or not ctx["key"] or not ctx["zone_id"]:
+        print(f"⚠️ Missing Cloudflare Credentials for {hostname}, cannot resolve Tunnel ID automatically.")
+        return None
+
+    zone_id = ctx["zone_id"]
+    with _TUNNEL_LOCK:
+        if _TUNNEL_INDEX is None:
+            _TUNNEL_INDEX = _load_tunnel_index()
+        zone = _TUNNEL_INDEX.get(zone_id)
+        fresh = zone and time.time() - zone["fetched_at"] < TUNNEL_CACHE_TTL
+        if fresh and hostname in zone["records"]:
+            return zone["records"][hostname]
+
+        # Miss or expired: re-list the zone (at most once per run)
+        if zone_id not in _TUNNEL_REFRESHED:
+            _TUNNEL_REFRESHED.add(zone_id)
+            try:
+                records = _list_zone_tunnels(ctx)
+                zone = _TUNNEL_INDEX[zone_id] = {"fetched_at": time.time(), "records": records}
+                _save_tunnel_index(_TUNNEL_INDEX)
+                print(f"✅ Indexed {len(records)} tunnel CNAMEs for zone {zone_id[:8]}")
+            except Exception as e:
+                print(f"❌ Failed to list tunnels for zone {zone_id[:8]}: {e}")
+                if zone and hostname in zone["records"]:
+                    print(f"⚠️ Using stale cached Tunnel ID for {hostname}")
+
+        return zone["records"].get(hostname) if zone else None
+
+# Dependency Bundles
+# xdotool/xclip and their dependency closure are kept as per-arch .deb bundles under
+# CACHE_DIR/debs/<arch>. A bundle is built with `apt-get download` locally (when the runner
+# has the same dpkg architecture) or on a donor agent of that arch that already has the deps.
+# Hosts receive only the packages dpkg reports missing and install them with `dpkg -i`, so
+# they don't need to reach an apt mirror. apt-get stays as the fallback.
+DEPS_PACKAGES = ["xdotool", "xclip"]
+DEPS_DIR = os.path.join(CACHE_DIR, "debs")
+DEPS_BUNDLE_TTL = int(os.getenv("DEPS_BUNDLE_TTL", str(30 * 86400)) or 0)  # rebuild for security updates
+
+# Prints a tar of every .deb in the closure of the packages (virtual/unavailable ones are skipped)
+DEPS_BUILD_SCRIPT = r"""
+set -e
+d=$(mktemp -d); trap 'rm -rf "$d"' EXIT; cd "$d"
+for p in $(apt-cache depends --recurse --no-recommends --no-suggests --no-conflicts --no-breaks \
+             --no-replaces --no-enhances %s | grep '^[a-z0-9]' | sort -u); do
+  apt-get download "$p" >/dev/null 2>&1 || true
+done
+ls ./*.deb >/dev/null
+tar -c ./*.deb | %s
+"""
+
+# stdin: sudo password line, then a tar of .debs. A failed dpkg -i leaves packages unpacked but
+# unconfigured, which would also break the apt-get fallback: repair with apt-get -f, else purge
+# the packages just unpacked (%s: their names)
+DEPS_INSTALL_CMD = ('read -r P && t=$(mktemp -d) && tar -x -C "$t" && '
+                    'echo "$P" | sudo -S dpkg -i "$t"/*.deb; rc=$?; rm -rf "$t"; '
+                    'if [ $rc -ne 0 ]; then echo "$P" | sudo -S apt-get -f install -y >&2 || '
+                    'echo "$P" | sudo -S dpkg --purge %s >&2; fi; exit $rc')
+OS_RELEASE_CMD = '. /etc/os-release && echo "$ID-$VERSION_CODENAME"'
+
+DEPS_VERSIONS = {}  # ssh_host -> {package: version} recorded after provisioning
+_DEPS_LOCK = threading.Lock()
+_DEPS_UNAVAILABLE = set()  # bundle keys that could not be built this run
+
+def _deb_arch(arch):
+    return {"arm": "armhf"}.get(arch, arch)
+
+def _bundle_key(arch, release):
+    """Bundles are per arch and distro release (os-release ID-VERSION_CODENAME, e.g. ubuntu-jammy)."""
+    return f"{arch}-{release}"
+
+def _load_deps_bundle(key):
+    try:
+        with open(os.path.join(DEPS_DIR, key, "manifest.json")) as f:
+            bundle = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if DEPS_BUNDLE_TTL and time.time() - bundle.get("built_at", 0) > DEPS_BUNDLE_TTL:
+        return None
+    return bundle
+
+def _store_deps_bundle(arch, release, tar_bytes, source):
+    """Unpack a tar of .debs into the cache and write its manifest. Returns the bundle."""
+    from urllib.parse import unquote
+    key = _bundle_key(arch, release)
+    bundle_dir = os.path.join(DEPS_DIR, key)
+    shutil.rmtree(bundle_dir, ignore_errors=True)
+    os.makedirs(bundle_dir)
+    packages = {}
+    with tarfile.open(fileobj=io.BytesIO(tar_bytes)) as tar:
+        for member in tar.getmembers():
+            fname = os.path.basename(member.name)
+            if not member.isfile() or not fname.endswith(".deb"):
+                continue
+            with open(os.path.join(bundle_dir, fname), "wb") as out:
+                out.write(tar.extractfile(member).read())
+            # apt-get download names files <package>_<version>_<arch>.deb (':' quoted as %3a)
+            name, version, _ = fname[:-4].split("_", 2)
+            packages[name] = {"version": unquote(version), "file": fname}
+    bundle = {"key": key, "arch": arch, "release": release, "built_at": time.time(), "source": source,
+              "packages": packages}
+    with open(os.path.join(bundle_dir, "manifest.json"), "w") as f:
+        json.dump(bundle, f, indent=2)
+    return bundle
+
+def _local_dpkg_arch():
+    if not shutil.which("dpkg") or not shutil.which("apt-get"):
+        return None
+    ret = subprocess.run(["dpkg", "--print-architecture"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    return ret.stdout.strip() if ret.returncode == 0 else None
+
+def _local_release():
+    ret = subprocess.run(["bash", "-c", OS_RELEASE_CMD], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    return ret.stdout.strip() if ret.returncode == 0 else None
+
+def host_release(ssh_host, state=None):
+    """Distro release of the agent (ID-VERSION_CODENAME): the probed value, else read over SSH."""
+    if state and state.get("release"):
+        return state["release"]
+    ret = run_ssh(ssh_host, OS_RELEASE_CMD)
+    release = ret.stdout.strip() if ret.returncode == 0 else ""
+    # Without a codename the release can't be told apart from other versions of the distro
+    return release if release and not release.endswith("-") else None
+
+def _deps_donors(arch, release, exclude):
+    """Agents of this arch and release whose dependencies were last seen installed (from the state store)."""
+    with _state_conn() as conn:
+        rows = conn.execute("SELECT ssh_host FROM agents WHERE arch = ? AND release = ? AND deps_ok = 1",
+                            (arch, release)).fetchall()
+    return [r["ssh_host"] for r in rows if r["ssh_host"] != exclude]
+
+def deps_bundle(arch, release, exclude=None):
+    """Return the cached dependency bundle for arch+release, building it once if needed (None if impossible)."""
+    key = _bundle_key(arch, release)
+    with _DEPS_LOCK:
+        bundle = _load_deps_bundle(key)
+        if bundle or key in _DEPS_UNAVAILABLE:
+            return bundle
+        bundle = _build_deps_bundle(arch, release, exclude)
+        if not bundle:
+            _DEPS_UNAVAILABLE.add(key)
+        return bundle
+
+def _build_deps_bundle(arch, release, exclude):
+    pkgs = " ".join(DEPS_PACKAGES)
+    key = _bundle_key(arch, release)
+    try:
+        # The runner's packages only fit the agents if it runs the same arch and distro release
+        if _local_dpkg_arch() == _deb_arch(arch) and _local_release() == release:
+            print(f"📦 Building {key} dependency bundle locally...")
+            ret = subprocess.run(["bash", "-c", DEPS_BUILD_SCRIPT % (pkgs, "cat")],
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if ret.returncode == 0:
+                return _store_deps_bundle(arch, release, ret.stdout, "local")
+            print(f"⚠️ Local bundle build failed: {ret.stderr.decode(errors='replace').strip()[-200:]}")
+        for donor in _deps_donors(arch, release, exclude)[:2]:
+            print(f"📦 Building {key} dependency bundle on donor {donor}...")
+            ret = run_ssh(donor, DEPS_BUILD_SCRIPT % (pkgs, "base64 -w0"))
+            if ret.returncode == 0:
+                import base64
+                return _store_deps_bundle(arch, release, base64.b64decode(ret.stdout.strip()), donor)
+            print(f"⚠️ Donor build on {donor} failed: {redact_secrets(ret.stderr.strip())[-200:]}")
+        return None
+    except (OSError, ValueError, tarfile.TarError) as e:
+        print(f"⚠️ Dependency bundle for {key} unusable: {redact_secrets(e)}")
     return None
 
+def _installed_packages(ssh_host, packages):
+    """{package: version} of the given packages that dpkg reports installed on the host."""
+    fmt = "'${Package} ${Version} ${db:Status-Status}\\n'"
+    ret = run_ssh(ssh_host, f"dpkg-query -W -f={fmt} {' '.join(packages)} 2>/dev/null; true")
+    installed = {}
+    for line in ret.stdout.splitlines():
+        parts = line.split()
+        if len(parts) == 3 and parts[2] == "installed":
+            installed[parts[0]] = parts[1]
+    return installed
 
+def _install_from_bundle(ssh_host, bundle):
+    packages = bundle["packages"]
+    missing = sorted(set(packages) - set(_installed_packages(ssh_host, packages)))
+    if not missing:
+        return True
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w") as tar:
+        for name in missing:
+            tar.add(os.path.join(DEPS_DIR, bundle["key"], packages[name]["file"]), arcname=packages[name]["file"])
+    print(f"📦 Installing {len(missing)} of {len(packages)} bundled packages ({len(buf.getvalue()) // 1024} KB) offline...")
+    ret = run_ssh(ssh_host, DEPS_INSTALL_CMD % " ".join(missing), input=f"{SSH_PASS}\n".encode() + buf.getvalue())
+    if ret.returncode != 0:
+        print(f"⚠️ Offline install failed: {redact_secrets(ret.stderr.strip())[-300:]}")
+        return False
+    return True
 
-def install_dependencies(ssh_host):
+def _apt_install(ssh_host):
+    # The sudo password arrives on stdin, never in argv
+    cmd = ('read -r P && echo "$P" | sudo -S apt-get update && '
+           f'echo "$P" | sudo -S apt-get install -y {" ".join(DEPS_PACKAGES)}')
+    ret = run_ssh(ssh_host, cmd, input=f"{SSH_PASS}\n".encode())
+    if ret.returncode != 0:
+        print(f"⚠️ Dependency install failed: {redact_secrets(ret.stderr)}")
+        return False
+    return True
+
+@traced("deps_install")
+def install_dependencies(ssh_host, arch=None, release=None):
     print(f"📦 Installing dependencies on {ssh_host}...")
     # xdotool, xclip for automation
-    cmd = f"echo {SSH_PASS} | sudo -S apt-get update && echo {SSH_PASS} | sudo -S apt-get install -y xdotool xclip"
-    ret = run_ssh(ssh_host, cmd)
-    if ret.returncode != 0:
-        print(f"⚠️ Dependency install failed: {ret.stderr}")
+    arch = normalize_arch(arch)
+    release = release or host_release(ssh_host)
+    bundle = deps_bundle(arch, release, exclude=ssh_host) if release else None
+    if bundle and _install_from_bundle(ssh_host, bundle):
+        span_attr(mode="bundle")
     else:
-        print("✅ Dependencies installed.")
+        print("📦 Falling back to apt-get...")
+        span_attr(mode="apt")
+        if not _apt_install(ssh_host):
+            return False
+    versions = _installed_packages(ssh_host, DEPS_PACKAGES)
+    DEPS_VERSIONS[ssh_host] = versions
+    missing = [p for p in DEPS_PACKAGES if p not in versions]
+    if missing:
+        print(f"⚠️ Still missing after install: {', '.join(missing)}")
+        return False
+    print(f"✅ Dependencies installed: {', '.join(f'{p} {v}' for p, v in sorted(versions.items()))}")
+    return True
 
-def configure_gemini(ssh_host):
-    print(f"⚙️ Configuring Gemini/MCP on {ssh_host}...")
-    
-    # 1. Prepare Content
-    mcp_config = {
-        "mcpServers": {
-            "gravity_bridge": {
-                "command": "/home/sw/gravity-agent/gravity-agent",
-                "args": [],
-                "disabled": False,
-                "autoApprove": []
-            }
+# Agent Config Rendering
+# The MCP config, GEMINI.md rules and .env are rendered in memory per agent and compared by
+# sha256 with what the host reports (probe, or the check command). Only the files that differ
+# are sent, as one tar stream over the host's session, extracted relative to $HOME.
+CONFIG_FILES = {
+    "mcp_config.json": ".gemini/antigravity/mcp_config.json",
+    "GEMINI.md": ".gemini/GEMINI.md",
+    ".env": "gravity-agent/.env",
+}
+MCP_CONFIG = {
+    "mcpServers": {
+        "gravity_bridge": {
+            "command": "/home/sw/gravity-agent/gravity-agent",
+            "args": [],
+            "disabled": False,
+            "autoApprove": []
         }
     }
-    
-    rules_content = """你在 IDE 中工作，当你完成用户请求的最终答复时，必须遵守以下规则：
+}
+GEMINI_RULES = """你在 IDE 中工作，当你完成用户请求的最终答复时，必须遵守以下规则：
 
 1. 立即调用 MCP 工具 `gravity_bridge`，将完整最终答复发送到 Telegram。
 2. 如果内容较长，允许拆分为多次 `gravity_bridge` 调用，优先按段落或符合Telegram阅读的代码块，边界拆分，保持 ``` 代码块结构完整。
 3. MCP 工具 `gravity_bridge`调用成功后，在 IDE 对话中不要重复输出全文，只输出一句： ok
 """
+# Liveness plus the deployed config hashes, in one round-trip
+CONFIG_CHECK_SCRIPT = ("pgrep -x gravity-agent >/dev/null && echo running || echo stopped; "
+                       f"cd ~ && sha256sum {' '.join(CONFIG_FILES.values())} 2>/dev/null; true")
 
-    # 2. Write Temp Files
-    with open("mcp_config.json.tmp", "w") as f:
-        json.dump(mcp_config, f, indent=4)
-        
-    with open("GEMINI.md.tmp", "w") as f:
-        f.write(rules_content)
-        
-    # 3. Create Remote Dirs
-    run_ssh(ssh_host, "mkdir -p ~/.gemini/antigravity")
-    
-    # 4. SCP Files
-    subprocess.run(["sshpass", "-p", SSH_PASS, "scp", "-o", "StrictHostKeyChecking=no", "mcp_config.json.tmp", f"{SSH_USER}@{ssh_host}:~/.gemini/antigravity/mcp_config.json"])
-    subprocess.run(["sshpass", "-p", SSH_PASS, "scp", "-o", "StrictHostKeyChecking=no", "GEMINI.md.tmp", f"{SSH_USER}@{ssh_host}:~/.gemini/GEMINI.md"])
-    
-    # 5. Cleanup
-    os.remove("mcp_config.json.tmp")
-    os.remove("GEMINI.md.tmp")
-    print("✅ Gemini Configured.")
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
 
-def restart_services(agents):
-    for name, info in agents.items():
-        if isinstance(info, str): continue
-        ssh_host = info.get("ssh_host")
-        if not ssh_host: continue
+def render_env(name, info, args, quiet=False):
+    """Build the agent's .env (resolving its tunnel ID). Returns the text, or None on failure.
 
-        print(f"🔄 Restarting {name}...")
-        
-        # 1. Ensure binary is executable (SCP might lose permissions)
-        run_ssh(ssh_host, "chmod +x ~/gravity-agent/gravity-agent")
-
-        # 2. Restart (Ignore pkill failure if process doesn't exist)
-        # Use -x (exact match) to avoid killing the SSH command itself which contains "gravity-agent"
-        # Target REAL Desktop (Found X10 socket in debug run).
-        cmd = "(pkill -9 -x gravity-agent || true); export DISPLAY=:10; xhost +local: >/dev/null 2>&1 || true; nohup ~/gravity-agent/gravity-agent > ~/gravity-agent/agent.log 2>&1 &"
-        ret = run_ssh(ssh_host, cmd)
-        
-        if ret.returncode == 0:
-            print(f"✅ {name}: Restart Triggered")
+    quiet=True (planning, checks) skips the progress output and the failure alert.
+    """
+    ssh_host = info["ssh_host"]
+    public_url = info.get("url")
+    say = (lambda *a: None) if quiet else print
+
+    # Strict Automation: Resolve or Fail (the SSH host is the source of truth for the tunnel ID)
+    say(f"🔍 Resolving Tunnel ID via DNS for SSH Host: {ssh_host}...")
+    tunnel_id = resolve_tunnel_id(ssh_host)
+    
+    if not tunnel_id:
+        # Check if user provided an override (still useful for debugging but not relied upon)
+        if getattr(args, "tunnel_id", None):
+            say(f"⚠️ DNS Resolution failed, but using manual override: {args.tunnel_id}")
+            tunnel_id = args.tunnel_id
         else:
-            print(f"❌ {name}: Restart Failed. Exit Code: {ret.returncode}")
-            print(f"   Stdout: {ret.stdout}")
-            print(f"   Stderr: {ret.stderr}")
+            if not quiet:
+                msg = f"❌ **Deployment Failed**: Could not resolve Tunnel ID for `{ssh_host}`.\nEnsure the server has a Cloudflare Tunnel running and the DNS record exists."
+                print(msg)
+                send_telegram(msg)
+            return None
 
-def debug_agent(name, agents):
-    info = agents.get(name)
-    if not info:
-        print(f"❌ Agent {name} not found")
-        return
-        
-    ssh_host = info.get("ssh_host")
-    if not ssh_host:
-        print(f"❌ No ssh_host for {name}")
-        return
+    say(f"✅ Resolved Tunnel ID: {tunnel_id}")
+    return f"""AGENT_NAME={name}
+TUNNEL_ID={tunnel_id}
+PUBLIC_URL={public_url}
+WORKER_URL=https://gravity-bridge-worker.58.workers.dev
+GITHUB_TOKEN={GH_TOKEN}
+HEADLESS=true
+"""
 
-    print(f"🔍 Debugging {name} ({ssh_host})...")
-    
-    commands = [
-        ("Process Status", "pgrep -a gravity-agent || echo 'Not Running'"),
-        ("File Permissions", "ls -la ~/gravity-agent/"),
-        ("Agent Log (Last 200 lines)", "tail -n 200 ~/gravity-agent/agent.log || echo 'No Log'"),
-        ("Env File Check", "cat ~/gravity-agent/.env || echo 'No Env'"),
-        ("Env File Check", "cat ~/gravity-agent/.env || echo 'No Env'"),
-        ("Binary Test (Version/Help)", "~/gravity-agent/gravity-agent --help || echo 'Binary Exec Failed'"),
-        ("Architecture Check", "uname -a"),
-        ("Display Check", "ls -la /tmp/.X11-unix/ || echo 'No X11 Sockets'"),
-        ("Active Users", "w || echo 'w failed'")
-    ]
+def render_config(name, info, args, quiet=True):
+    """Desired config files {key: bytes}; ".env" is None when its tunnel ID can't be resolved."""
+    env = render_env(name, info, args, quiet=quiet)
+    return {
+        "mcp_config.json": json.dumps(MCP_CONFIG, indent=4).encode(),
+        "GEMINI.md": GEMINI_RULES.encode(),
+        ".env": env.encode() if env is not None else None,
+    }
 
-    for title, cmd in commands:
-        print(f"\n--- {title} ---")
-        ret = run_ssh(ssh_host, cmd)
-        print(f"Exit: {ret.returncode}")
-        print(ret.stdout)
-        if ret.stderr:
-            print(f"Stderr: {ret.stderr}")
+def config_hashes(files):
+    """{key: sha256} of the MCP config and rules (the .env hash is kept separately as env_hash)."""
+    return {key: content_hash(data) for key, data in files.items() if key != ".env"}
 
-def check_remote_md5(ssh_host, path):
-    cmd = f"md5sum {path} | awk '{{print $1}}'"
+def config_drift(desired, remote):
+    """Keys whose remote hash differs from the desired content (an unrenderable .env only when missing)."""
+    drift = []
+    for key, data in desired.items():
+        if data is None:
+            if not remote.get(key):
+                drift.append(key)
+        elif content_hash(data) != remote.get(key):
+            drift.append(key)
+    return drift
+
+@traced("config")
+def push_config(ssh_host, files):
+    """Send config files ({key: bytes}) to the host in one tar stream."""
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w") as tar:
+        for key, data in files.items():
+            member = tarfile.TarInfo(CONFIG_FILES[key])
+            member.size, member.mtime = len(data), int(time.time())
+            member.mode = 0o600 if key == ".env" else 0o644  # .env holds the GitHub token
+            tar.addfile(member, io.BytesIO(data))
+    dirs = sorted({os.path.dirname(CONFIG_FILES[key]) for key in files})
+    ret = run_ssh(ssh_host, f"cd ~ && mkdir -p {' '.join(dirs)} && tar -xf -", input=buf.getvalue())
+    if ret.returncode != 0:
+        print(f"❌ Config sync failed: {redact_secrets(ret.stderr.strip())}")
+        return False
+    print(f"📤 Config synced: {', '.join(files)} ({len(buf.getvalue()) / 1024:.1f} KB)")
+    return True
+
+RESTARTED = {}  # name -> time of the last successful restart
+
+@traced("restart")
+def restart_agent(name, info):
+    ssh_host = info.get("ssh_host")
+    print(f"🔄 Restarting {name}...")
+
+    # 1. Ensure binary is executable (SCP might lose permissions)
+    run_ssh(ssh_host, "chmod +x ~/gravity-agent/gravity-agent")
+
+    # 2. Restart (Ignore pkill failure if process doesn't exist)
+    # Use -x (exact match) to avoid killing the SSH command itself which contains "gravity-agent"
+    # Target REAL Desktop (Found X10 socket in debug run).
+    # The previous log is rotated to agent.log.1 (not truncated) so the log collector can drain it.
+    cmd = ("(pkill -9 -x gravity-agent || true); export DISPLAY=:10; xhost +local: >/dev/null 2>&1 || true; "
+           "(test -s ~/gravity-agent/agent.log && mv -f ~/gravity-agent/agent.log ~/gravity-agent/agent.log.1 || true); "
+           "nohup ~/gravity-agent/gravity-agent > ~/gravity-agent/agent.log 2>&1 &")
     ret = run_ssh(ssh_host, cmd)
+
     if ret.returncode == 0:
-        return ret.stdout.strip()
-    return None
+        print(f"✅ {name}: Restart Triggered")
+        RESTARTED[name] = time.time()
+        return True, "restart triggered"
+    print(f"❌ {name}: Restart Failed. Exit Code: {ret.returncode}")
+    print(f"   Stdout: {ret.stdout}")
+    print(f"   Stderr: {ret.stderr}")
+    return False, f"restart failed (exit {ret.returncode})"
+
+# Readiness Polling
+# After a restart, poll with exponential backoff until the agent has been up for
+# READY_MIN_UPTIME seconds (plus the optional log marker / health endpoint) or the
+# deadline passes. Time-to-ready is recorded per agent.
+READY_DEADLINE = float(os.getenv("READY_DEADLINE", "60") or 60)
+READY_MIN_UPTIME = int(os.getenv("READY_MIN_UPTIME", "5") or 5)
+READY_POLL_INITIAL = 1.0
+READY_PATTERN = os.getenv("AGENT_READY_PATTERN", "").strip()  # grep -E pattern expected in agent.log
+READY_TIMES = {}  # name -> seconds from restart to ready
 
-def check_remote_deps(ssh_host):
-    # Returns True if deps exist
-    cmd = "which xdotool && which xclip"
+def _poll_ready(ssh_host):
+    marker = f"grep -qE {shlex.quote(READY_PATTERN)} ~/gravity-agent/agent.log && m=1" if READY_PATTERN else "m=1"
+    cmd = ("pid=$(pgrep -x gravity-agent | head -n 1); up=0; m=0; "
+           "[ -n \"$pid\" ] && up=$(ps -o etimes= -p \"$pid\" | tr -d ' '); "
+           f"{marker}; echo \"${{pid:-0}} ${{up:-0}} $m\"")
     ret = run_ssh(ssh_host, cmd)
-    return ret.returncode == 0
+    try:
+        pid, uptime, marker_found = (int(x) for x in ret.stdout.split()[-3:])
+    except ValueError:
+        return None
+    return pid, uptime, bool(marker_found)
+
+def _health_ok(url):
+    try:
+        return http_request("health", "GET", url).status_code < 400
+    except Exception:
+        return False
+
+@traced("ready_wait")
+def wait_ready(name, info, since=None):
+    """Poll until the agent is ready. Returns (ok, detail) and records READY_TIMES[name]."""
+    ssh_host = info["ssh_host"]
+    since = since or RESTARTED.get(name) or time.time()
+    deadline = since + READY_DEADLINE
+    budget = remaining_budget()
+    if budget is not None:
+        deadline = min(deadline, time.time() + budget - BUDGET_GRACE)
+    delay, pids, last = READY_POLL_INITIAL, [], None
+    while ssh_host not in UNREACHABLE:
+        time.sleep(min(delay, max(deadline - time.time(), 0)))
+        last = _poll_ready(ssh_host)
+        if last:
+            pid, uptime, marker = last
+            if pid and (not pids or pids[-1] != pid):
+                pids.append(pid)
+            healthy = not info.get("health_url") or _health_ok(info["health_url"])
+            if pid and uptime >= READY_MIN_UPTIME and marker and healthy:
+                elapsed = time.time() - since
+                READY_TIMES[name] = elapsed
+                print(f"✅ {name}: Ready in {elapsed:.1f}s")
+                return True, f"ready in {elapsed:.1f}s"
+        if time.time() >= deadline:
+            break
+        delay = min(delay * 2, 8)
+
+    if len(pids) > 1:
+        reason = f"crash loop ({len(pids)} PIDs)"
+    elif not last or not last[0]:
+        reason = "not running"
+    elif last[1] < READY_MIN_UPTIME:
+        reason = "restarting"
+    elif not last[2]:
+        reason = "no readiness marker in agent.log"
+    else:
+        reason = "health check failing"
+    tail = run_ssh(ssh_host, "tail -n 20 ~/gravity-agent/agent.log").stdout.strip()
+    if ssh_host in UNREACHABLE:
+        return False, f"not ready: unreachable ({UNREACHABLE[ssh_host]})"
+    print(f"❌ {name}: Not ready after {READY_DEADLINE:.0f}s ({reason})")
+    if tail:
+        print(f"   Last log lines:\n{tail}")
+    send_telegram(f"❌ **Agent Not Ready**: `{name}` {reason} after {READY_DEADLINE:.0f}s.\n```\n{tail[-1500:]}\n```")
+    return False, f"not ready: {reason}"
+
+def restart_and_wait(name, info):
+    ok, detail = restart_agent(name, info)
+    if not ok:
+        return ok, detail
+    return wait_ready(name, info)
+
+def restart_services(agents, max_workers=None):
+    targets = {name: info for name, info in agents.items()
+               if not isinstance(info, str) and info.get("ssh_host")}
+    results = run_parallel(targets, restart_and_wait, max_workers)
+    print_summary("Restart", results)
+    return results
+
+# Diagnostics
+# The whole bundle runs as one remote script; its output is streamed into a gzip archive per
+# host (and to the console when a single agent is debugged), with an index.json per run.
+DIAG_DIR = os.getenv("MAINT_DIAG_DIR", "").strip() or os.path.join(CACHE_DIR, "diagnostics")
+DIAG_KEEP = int(os.getenv("MAINT_DIAG_KEEP", "10") or 0)  # past run directories kept (0 = all)
+DIAG_MARK = "@@gravitybridge-diag"
+DIAG_SECTIONS = [
+    ("Process Status", "pgrep -a gravity-agent || echo 'Not Running'"),
+    ("File Permissions", "ls -la ~/gravity-agent/"),
+    ("Agent Log (Last 200 lines)", "tail -n 200 ~/gravity-agent/agent.log || echo 'No Log'"),
+    ("Env File Check", "sed -E 's/^([A-Za-z_]*(TOKEN|KEY|PASS|SECRET)[A-Za-z_]*)=.*/\\1=***/' ~/gravity-agent/.env || echo 'No Env'"),
+    ("Binary Test (Version/Help)", "~/gravity-agent/gravity-agent --help || echo 'Binary Exec Failed'"),
+    ("Architecture Check", "uname -a"),
+    ("Display Check", "ls -la /tmp/.X11-unix/ || echo 'No X11 Sockets'"),
+    ("Active Users", "w || echo 'w failed'"),
+]
+DIAG_INDEX = {}
+
+def _diag_script():
+    parts = []
+    for i, (title, cmd) in enumerate(DIAG_SECTIONS):
+        parts.append(f"echo {shlex.quote(f'{DIAG_MARK} {i}')}; ( {cmd} ) 2>&1; echo \"{DIAG_MARK}-exit {i} $?\"")
+    return "\n".join(parts)
+
+def collect_diagnostics(name, info, run_dir, echo=False):
+    """Stream the diagnostics bundle for one agent into run_dir/<name>.log.gz."""
+    ssh_host = info["ssh_host"]
+    path = os.path.join(run_dir, f"{name}.log.gz")
+    sections = {}
+    entry = {"ssh_host": ssh_host, "file": os.path.basename(path), "sections": sections}
+    DIAG_INDEX[name] = entry
+
+    with gzip.open(path, "wt", encoding="utf-8") as archive:
+        def emit(text):
+            text = redact_secrets(text)
+            archive.write(text)
+            if echo:
+                print(text, end="")
+
+        def on_line(line):
+            if line.startswith(f"{DIAG_MARK}-exit "):
+                idx, code = line.split()[1:3]
+                sections[DIAG_SECTIONS[int(idx)][0]] = int(code)
+                emit(f"Exit: {code}\n")
+            elif line.startswith(f"{DIAG_MARK} "):
+                emit(f"\n--- {DIAG_SECTIONS[int(line.split()[1])][0]} ---\n")
+            else:
+                emit(line)
+
+        emit(f"# {name} ({ssh_host}) {time.strftime('%Y-%m-%d %H:%M:%S %Z')}\n")
+        code = run_ssh_stream(ssh_host, _diag_script(), on_line)
+
+    entry.update(exit_code=code, bytes=os.path.getsize(path))
+    if code == 255 or not sections:
+        return False, f"unreachable (exit {code})"
+    failed = [title for title, rc in sections.items() if rc != 0]
+    detail = f"{len(sections)} sections, {entry['bytes'] / 1024:.1f} KB"
+    return not failed, detail + (f", failed: {', '.join(failed)}" if failed else "")
+
+def debug_agents(agents, target, max_workers=None):
+    """Collect diagnostics from every targeted agent concurrently; returns the run directory."""
+    targets = select_targets(agents, target)
+    if target != "all":
+        for name in (n.strip() for n in target.split(",")):
+            if name and name not in targets:
+                print(f"❌ Agent {name} not found or has no ssh_host")
+    if not targets:
+        return None
+
+    run_dir = os.path.join(DIAG_DIR, time.strftime("%Y%m%dT%H%M%SZ", time.gmtime()))
+    os.makedirs(run_dir, exist_ok=True)
+    if DIAG_KEEP:
+        # Run directories are named by UTC start time, so name order is age order
+        runs = sorted((e.path for e in os.scandir(DIAG_DIR) if e.is_dir()), reverse=True)
+        for old in runs[DIAG_KEEP:]:
+            shutil.rmtree(old, ignore_errors=True)
+    DIAG_INDEX.clear()
+    if len(targets) == 1:
+        # Single agent: stream to the console as it arrives
+        name, info = next(iter(targets.items()))
+        print(f"🔍 Debugging {name} ({info['ssh_host']})...")
+        start = time.time()
+        ok, detail = collect_diagnostics(name, info, run_dir, echo=True)
+        results = [{"name": name, "ok": ok, "detail": detail, "seconds": time.time() - start}]
+    else:
+        print(f"🔍 Collecting diagnostics from {len(targets)} agents...")
+        results = run_parallel(targets, lambda name, info: collect_diagnostics(name, info, run_dir), max_workers)
+
+    for r in results:
+        DIAG_INDEX.setdefault(r["name"], {}).update(ok=r["ok"], detail=r["detail"], seconds=round(r["seconds"], 2))
+    with open(os.path.join(run_dir, "index.json"), "w") as f:
+        json.dump({"run": RUN_ID, "created": time.time(), "hosts": DIAG_INDEX}, f, indent=2)
+    print_summary("Debug", results)
+    print(f"🗂️ Diagnostics archived in {run_dir}")
+    return run_dir
+
+# Log Collection
+# agent.log of every host is tailed incrementally: a cursor (inode, byte offset) per agent means
+# each run only transfers what was appended since the last one. Restarts rotate the log to
+# agent.log.1, and a cursor pointing at the rotated inode first drains it, so pre-restart lines
+# aren't lost (unless the log rotated twice between collections). Lines land in a local SQLite
+# store indexed by time and full text (FTS5) for fleet-wide search without touching the hosts.
+LOG_DB = os.path.join(CACHE_DIR, "agent_logs.db")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(4 * 1024 * 1024)) or 0)  # per file per collection, 0 = unlimited
+LOG_RETENTION_DAYS = int(os.getenv("LOG_RETENTION_DAYS", "14") or 0)
+LOG_MARK = "@@gravitybridge-log"
+# Prints "<mark> <inode> <start> <length>" followed by exactly <length> bytes, per file segment
+LOG_TAIL_SCRIPT = r"""
+set -- %(inode)d %(offset)d %(max)d
+cd ~/gravity-agent 2>/dev/null || exit 0
+seg() {
+  size=$(stat -c %%s "$1"); s=$2
+  [ "$s" -gt "$size" ] && s=0
+  [ "$3" -gt 0 ] && [ $((size - s)) -gt "$3" ] && s=$((size - $3))
+  echo "%(mark)s $(stat -c %%i "$1") $s $((size - s))"
+  tail -c +$((s + 1)) "$1" | head -c $((size - s))
+}
+li=$(stat -c %%i agent.log 2>/dev/null); ri=$(stat -c %%i agent.log.1 2>/dev/null)
+if [ -n "$li" ] && [ "$li" = "$1" ]; then seg agent.log "$2" "$3"; exit 0; fi
+if [ -n "$ri" ]; then
+  if [ "$ri" = "$1" ]; then seg agent.log.1 "$2" "$3"; else seg agent.log.1 0 "$3"; fi
+fi
+if [ -n "$li" ]; then seg agent.log 0 "$3"; fi
+"""
+# Go's log package prefix ("2006/01/02 15:04:05"), read as UTC; other lines inherit the previous time
+LOG_TIME_RE = re.compile(rb"^(\d{4})[/-](\d\d)[/-](\d\d)[ T](\d\d):(\d\d):(\d\d)")
+
+_LOG_INIT = threading.Lock()
+_LOG_READY = False
+
+@contextlib.contextmanager
+def _log_conn():
+    global _LOG_READY
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    conn = sqlite3.connect(LOG_DB, timeout=30)
+    try:
+        with _LOG_INIT:
+            if not _LOG_READY:
+                conn.executescript("""
+                    CREATE TABLE IF NOT EXISTS log_lines (
+                        id INTEGER PRIMARY KEY, agent TEXT NOT NULL, ts REAL NOT NULL, line TEXT NOT NULL);
+                    CREATE INDEX IF NOT EXISTS log_lines_ts ON log_lines (ts);
+                    CREATE INDEX IF NOT EXISTS log_lines_agent_ts ON log_lines (agent, ts);
+                    CREATE VIRTUAL TABLE IF NOT EXISTS log_fts USING fts5(line, content='log_lines', content_rowid='id');
+                    CREATE TRIGGER IF NOT EXISTS log_lines_ai AFTER INSERT ON log_lines BEGIN
+                        INSERT INTO log_fts (rowid, line) VALUES (new.id, new.line); END;
+                    CREATE TRIGGER IF NOT EXISTS log_lines_ad AFTER DELETE ON log_lines BEGIN
+                        INSERT INTO log_fts (log_fts, rowid, line) VALUES ('delete', old.id, old.line); END;
+                    CREATE TABLE IF NOT EXISTS log_cursors (
+                        agent TEXT PRIMARY KEY, ssh_host TEXT, inode INTEGER, offset INTEGER, collected_at REAL);
+                """)
+                _LOG_READY = True
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+def _log_segments(data):
+    """Split LOG_TAIL_SCRIPT output into [(inode, start, bytes)]."""
+    segments, pos = [], 0
+    while pos < len(data):
+        nl = data.find(b"\n", pos)
+        header = data[pos:nl if nl >= 0 else len(data)].split()
+        if nl < 0 or len(header) != 4 or header[0] != LOG_MARK.encode():
+            break  # Short read (file shrank while being sent): keep what was parsed
+        inode, start, length = (int(x) for x in header[1:])
+        segments.append((inode, start, data[nl + 1:nl + 1 + length]))
+        pos = nl + 1 + length
+    return segments
+
+def _log_time(line, fallback):
+    m = LOG_TIME_RE.match(line)
+    if not m:
+        return fallback
+    try:
+        return float(calendar.timegm(tuple(int(x) for x in m.groups())))
+    except (ValueError, OverflowError):
+        return fallback
+
+@traced("logs")
+def collect_agent_log(name, info):
+    """Fetch what was appended to an agent's log since its cursor and index it."""
+    ssh_host = info["ssh_host"]
+    with _log_conn() as conn:
+        row = conn.execute("SELECT ssh_host, inode, offset FROM log_cursors WHERE agent = ?", (name,)).fetchone()
+    inode, offset = (row[1], row[2]) if row and row[0] == ssh_host else (0, 0)
+
+    script = LOG_TAIL_SCRIPT % {"inode": inode, "offset": offset, "max": LOG_MAX_BYTES, "mark": LOG_MARK}
+    ret = run_ssh(ssh_host, script, text=False)
+    if ret.returncode != 0:
+        print(f"❌ Log collection failed on {ssh_host} (exit {ret.returncode})")
+        return False, f"unreachable (exit {ret.returncode})" if ret.returncode == 255 else f"exit {ret.returncode}"
+    segments = _log_segments(ret.stdout)
+    if not segments:
+        return True, "no log"
+
+    now = time.time()
+    ts, rows, received = now, [], 0
+    for i, (seg_inode, start, data) in enumerate(segments):
+        live = i == len(segments) - 1
+        # The live file may end mid-line: that part is picked up by the next collection
+        end = data.rfind(b"\n") + 1 if live else len(data)
+        # Clipped to LOG_MAX_BYTES: the first line is partial
+        skip = data.find(b"\n") + 1 if start > (offset if seg_inode == inode else 0) else 0
+        for line in data[skip:end].splitlines():
+            if line.strip():
+                ts = _log_time(line, ts)
+                rows.append((name, ts, redact_secrets(line.decode("utf-8", errors="replace"))))
+        received += end
+        if live:
+            inode, offset = seg_inode, start + end
+
+    with _log_conn() as conn:
+        conn.executemany("INSERT INTO log_lines (agent, ts, line) VALUES (?, ?, ?)", rows)
+        conn.execute("""INSERT INTO log_cursors (agent, ssh_host, inode, offset, collected_at) VALUES (?, ?, ?, ?, ?)
+                        ON CONFLICT(agent) DO UPDATE SET ssh_host = excluded.ssh_host, inode = excluded.inode,
+                        offset = excluded.offset, collected_at = excluded.collected_at""",
+                     (name, ssh_host, inode, offset, now))
+    span_attr(bytes=received)
+    detail = f"{len(rows)} new lines, {received / 1024:.1f} KB"
+    return True, detail + (" (incl. rotated log)" if len(segments) > 1 else "")
+
+def collect_logs(agents, target=None, max_workers=None):
+    """Collect new log lines from every targeted agent concurrently, then apply retention."""
+    targets = select_targets(agents, target)
+    print(f"📜 Collecting logs from {len(targets)} agents...")
+    results = run_parallel(targets, collect_agent_log, max_workers)
+    if LOG_RETENTION_DAYS:
+        with _log_conn() as conn:
+            pruned = conn.execute("DELETE FROM log_lines WHERE ts < ?", (time.time() - LOG_RETENTION_DAYS * 86400,)).rowcount
+        if pruned:
+            print(f"🧹 Pruned {pruned} log lines older than {LOG_RETENTION_DAYS} days")
+    print_summary("Logs", results)
+    return results
 
-def check_remote_config(ssh_host):
-    # Returns True if config files exist
-    cmd = "[ -f ~/.gemini/antigravity/mcp_config.json ] && [ -f ~/.gemini/GEMINI.md ]"
+def search_logs(query, target=None, since=None, limit=50):
+    """Full-text search (FTS5 syntax) over collected logs, newest first. Returns [(agent, ts, line)]."""
+    sql = "SELECT l.agent, l.ts, l.line FROM log_fts JOIN log_lines l ON l.id = log_fts.rowid WHERE log_fts MATCH ?"
+    params = [query]
+    names = None if not target or target == "all" else [t.strip() for t in target.split(",") if t.strip()]
+    if names:
+        sql += f" AND l.agent IN ({', '.join('?' * len(names))})"
+        params += names
+    if since:
+        sql += " AND l.ts >= ?"
+        params.append(time.time() - since)
+    sql += " ORDER BY l.ts DESC, l.id DESC LIMIT ?"
+    params.append(limit)
+    start = time.time()
+    try:
+        with _log_conn() as conn:
+            rows = conn.execute(sql, params).fetchall()
+    except sqlite3.OperationalError as e:
+        print(f"❌ Invalid search query {query!r}: {e}")
+        return []
+    for agent, ts, line in reversed(rows):
+        print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(ts))}  {agent}  {line}")
+    print(f"🔎 {len(rows)} matches for {query!r} in {(time.time() - start) * 1000:.0f} ms"
+          + (f" (showing newest {limit})" if len(rows) == limit else ""))
+    return rows
+
+# Composite Remote Probe
+# One round-trip: the script prints a single JSON document describing the agent's state.
+PROBE_SCRIPT = r"""
+B="$HOME/gravity-agent/gravity-agent"
+S="$HOME/gravity-agent/.gravity-agent.sha256"
+h() { [ -f "$1" ] && sha256sum "$1" | awk '{print $1}'; }
+has() { command -v "$1" >/dev/null 2>&1 && echo true || echo false; }
+digest=""; size=null; mtime=null
+if [ -f "$B" ]; then
+  set -- $(stat -c '%s %Y %i' "$B"); size=$1; mtime=$2; inode=$3
+  # Sidecar "size mtime inode sha256": the binary is only re-read when its stat changed
+  read -r ssize smtime sinode sdigest 2>/dev/null < "$S"
+  if [ "$ssize $smtime $sinode" = "$size $mtime $inode" ] && [ -n "$sdigest" ]; then
+    digest=$sdigest
+  else
+    digest=$(h "$B") && echo "$size $mtime $inode $digest" > "$S"
+  fi
+fi
+mcp=$(h "$HOME/.gemini/antigravity/mcp_config.json")
+rules=$(h "$HOME/.gemini/GEMINI.md")
+env=false; [ -f "$HOME/gravity-agent/.env" ] && env=true
+envh=$(h "$HOME/gravity-agent/.env")
+pid=$(pgrep -x gravity-agent | head -n 1); uptime=null
+[ -n "$pid" ] && uptime=$(ps -o etimes= -p "$pid" | tr -d ' ')
+disk=$(df -Pk "$HOME" | awk 'NR==2 {print $4}')
+rel=$(ls "$HOME/gravity-agent/.releases" 2>/dev/null | grep -v '\.part$' | \
+  awk '{printf "%s\"%s\"", (NR > 1 ? ", " : ""), $1}')
+tpl=$(cd "$HOME/gravity-agent/templates" 2>/dev/null && find . -type f -exec sha256sum {} + | \
+  awk '{n = substr($0, 67); sub(/^\.\//, "", n); printf "%s\"%s\": \"%s\"", (NR > 1 ? ", " : ""), n, $1}')
+printf '{"binary": {"digest": "%s", "size": %s, "mtime": %s}, ' "$digest" "$size" "$mtime"
+printf '"deps": {"xdotool": %s, "xclip": %s}, ' "$(has xdotool)" "$(has xclip)"
+printf '"peer": {"sshpass": %s, "cloudflared": %s}, "releases": [%s], ' "$(has sshpass)" "$(has cloudflared)" "$rel"
+printf '"config": {"mcp_config.json": "%s", "GEMINI.md": "%s"}, "env": %s, ' "$mcp" "$rules" "$env"
+printf '"process": {"pid": %s, "uptime": %s}, "disk_free_kb": %s, ' "${pid:-null}" "${uptime:-null}" "${disk:-null}"
+rel_id=$( . /etc/os-release 2>/dev/null && [ -n "$VERSION_CODENAME" ] && echo "$ID-$VERSION_CODENAME")
+printf '"arch": "%s", "release": "%s", ' "$(uname -m)" "$rel_id"
+printf '"env_digest": "%s", "templates": {%s}}\n' "$envh" "$tpl"
+"""
+
+@traced("probe")
+def probe_remote(ssh_host):
+    """Collect the agent's remote state in one SSH call. Returns a dict, or None if unreachable."""
+    ret = run_ssh(ssh_host, PROBE_SCRIPT)
+    if ret.returncode != 0:
+        print(f"❌ Probe failed on {ssh_host} (exit {ret.returncode}): {redact_secrets(ret.stderr.strip())}")
+        return None
+    try:
+        state = json.loads(ret.stdout.strip().splitlines()[-1])
+    except (ValueError, IndexError) as e:
+        print(f"❌ Probe returned invalid JSON on {ssh_host}: {e}")
+        return None
+    # Empty hashes mean "file missing"
+    state["binary"]["digest"] = state["binary"]["digest"] or None
+    state["env_digest"] = state["env_digest"] or None
+    state["config"] = {k: v or None for k, v in state["config"].items()}
+    return state
+
+# Binary Transfer (block delta + compression, staged then atomically swapped)
+DELTA_BLOCK_SIZE = 64 * 1024
+REMOTE_BINARY = "~/gravity-agent/gravity-agent"
+REMOTE_STAGING = "~/gravity-agent/.gravity-agent.new"
+REMOTE_DIGEST = "~/gravity-agent/.gravity-agent.sha256"
+
+# Prints one sha256 per block of the remote binary (nothing if it doesn't exist)
+BLOCK_SIG_SCRIPT = """
+import hashlib, os, sys
+path, size = os.path.expanduser(sys.argv[1]), int(sys.argv[2])
+if os.path.isfile(path):
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(size), b""):
+            print(hashlib.sha256(block).hexdigest())
+"""
+
+# Rebuilds the new binary from stdin: zlib stream of ("C", block index) / ("L", literal) records
+DELTA_APPLY_SCRIPT = """
+import hashlib, os, struct, sys, zlib
+old_path, new_path = os.path.expanduser(sys.argv[1]), os.path.expanduser(sys.argv[2])
+size, want = int(sys.argv[3]), sys.argv[4]
+data = zlib.decompress(sys.stdin.buffer.read())
+old = open(old_path, "rb") if os.path.isfile(old_path) else None
+digest, i = hashlib.sha256(), 0
+with open(new_path, "wb") as out:
+    while i < len(data):
+        op, n = data[i:i + 1], struct.unpack(">I", data[i + 1:i + 5])[0]
+        i += 5
+        if op == b"C":
+            old.seek(n * size)
+            chunk = old.read(size)
+        else:
+            chunk, i = data[i:i + n], i + n
+        out.write(chunk)
+        digest.update(chunk)
+if digest.hexdigest() != want:
+    os.remove(new_path)
+    sys.exit("digest mismatch")
+os.chmod(new_path, 0o755)
+"""
+
+TRANSFER_STATS = {}
+
+def _remote_block_sigs(ssh_host):
+    cmd = f"python3 -c {shlex.quote(BLOCK_SIG_SCRIPT)} {REMOTE_BINARY} {DELTA_BLOCK_SIZE}"
     ret = run_ssh(ssh_host, cmd)
-    return ret.returncode == 0
+    if ret.returncode != 0:
+        return None
+    return ret.stdout.split()
+
+def _build_delta(data, remote_sigs):
+    out = []
+    for idx in range(0, len(data), DELTA_BLOCK_SIZE):
+        block = data[idx:idx + DELTA_BLOCK_SIZE]
+        n = idx // DELTA_BLOCK_SIZE
+        if n < len(remote_sigs) and hashlib.sha256(block).hexdigest() == remote_sigs[n]:
+            out.append(b"C" + struct.pack(">I", n))
+        else:
+            out.append(b"L" + struct.pack(">I", len(block)) + block)
+    return zlib.compress(b"".join(out), 6)
+
+_PAYLOADS = {}
+_PAYLOAD_LOCK = threading.Lock()
+
+def _binary_payload(local_path, kind):
+    """Return (data, digest, payload) for local_path; kind is "raw", "zlib" or "gzip".
+
+    The file contents and full compressed copies are built once per artifact, not once per host.
+    """
+    digest = file_digest(local_path)
+    with _PAYLOAD_LOCK:
+        if _PAYLOADS.get("digest") != digest:
+            _PAYLOADS.clear()
+            with open(local_path, "rb") as f:
+                _PAYLOADS.update(digest=digest, raw=f.read())
+        if kind not in _PAYLOADS:
+            compress = zlib.compress if kind == "zlib" else gzip.compress
+            _PAYLOADS[kind] = compress(_PAYLOADS["raw"], 6)
+        return _PAYLOADS["raw"], digest, _PAYLOADS[kind]
+
+@traced("binary_transfer")
+def push_binary(ssh_host, local_path):
+    """Stage the local binary on the host, sending only changed blocks, then atomically swap it in.
+
+    The running agent keeps its old inode, so the service does not need to be stopped
+    for the transfer; the caller restarts it afterwards. Returns True on success.
+    """
+    data, want, _ = _binary_payload(local_path, "raw")
+    run_ssh(ssh_host, "mkdir -p ~/gravity-agent")
+    # Swap, then record the new binary's digest in the sidecar so the next probe only needs a stat
+    swap = (f"mv -f {REMOTE_STAGING} {REMOTE_BINARY} && "
+            f"echo \"$(stat -c '%s %Y %i' {REMOTE_BINARY}) {want}\" > {REMOTE_DIGEST}")
+
+    # Staged on the host by the peer distribution tree: install from that copy
+    if ssh_host in SEEDED.get(want, ()):
+        cached = f"{REMOTE_RELEASES}/{want}"
+        cmd = (f"[ \"$(sha256sum {cached} | awk '{{print $1}}')\" = {want} ] && cp {cached} {REMOTE_STAGING} "
+               f"&& chmod 755 {REMOTE_STAGING} && {swap}")
+        if run_ssh(ssh_host, cmd).returncode == 0:
+            span_attr(bytes=0, mode="peer", saved=len(data))
+            TRANSFER_STATS[ssh_host] = {"mode": "peer", "size": len(data), "sent": 0, "saved": len(data), "at": time.time()}
+            print(f"📤 Binary peer: installed the copy staged by the distribution tree ({len(data) // 1024} KB)")
+            return True
+        print("⚠️ Staged copy missing or corrupt, transferring directly")
+
+    payload = None
+    sigs = _remote_block_sigs(ssh_host)
+    if sigs:
+        payload = _build_delta(data, sigs)
+        if len(payload) >= len(_binary_payload(local_path, "zlib")[2]):
+            payload = None  # Nothing reusable, the plain compressed copy is smaller
+
+    if payload is not None:
+        mode = "delta"
+        cmd = (f"python3 -c {shlex.quote(DELTA_APPLY_SCRIPT)} {REMOTE_BINARY} {REMOTE_STAGING} "
+               f"{DELTA_BLOCK_SIZE} {want} && {swap}")
+        ret = run_ssh(ssh_host, cmd, input=payload)
+        if ret.returncode != 0:
+            print(f"⚠️ Delta transfer failed ({redact_secrets(ret.stderr.strip())}), falling back to full copy")
+            payload = None
+
+    if payload is None:
+        mode = "full"
+        # Plain shell fallback, works on hosts without python3
+        payload = _binary_payload(local_path, "gzip")[2]
+        cmd = (f"gzip -dc > {REMOTE_STAGING} && [ \"$(sha256sum {REMOTE_STAGING} | awk '{{print $1}}')\" = {want} ] "
+               f"&& chmod 755 {REMOTE_STAGING} && {swap} || {{ rm -f {REMOTE_STAGING}; exit 1; }}")
+        ret = run_ssh(ssh_host, cmd, input=payload)
+        if ret.returncode != 0:
+            print(f"❌ Binary transfer failed: {redact_secrets(ret.stderr.strip())}")
+            return False
+
+    saved = len(data) - len(payload)
+    span_attr(bytes=len(payload), mode=mode, saved=saved)
+    TRANSFER_STATS[ssh_host] = {"mode": mode, "size": len(data), "sent": len(payload), "saved": saved, "at": time.time()}
+    print(f"📤 Binary {mode}: sent {len(payload) // 1024} KB of {len(data) // 1024} KB (saved {saved * 100 // max(len(data), 1)}%)")
+    return True
+
+def print_ready_stats():
+    if not READY_TIMES:
+        return
+    times = sorted(READY_TIMES.values())
+    slowest = max(READY_TIMES, key=READY_TIMES.get)
+    print(f"\n⏱️ Time to Ready: {len(times)} agents, median {times[len(times) // 2]:.1f}s, max {times[-1]:.1f}s ({slowest})")
+
+def print_transfer_stats():
+    if not TRANSFER_STATS:
+        return
+    size = sum(t["size"] for t in TRANSFER_STATS.values())
+    sent = sum(t["sent"] for t in TRANSFER_STATS.values())
+    print(f"\n📦 Binary Transfers: {len(TRANSFER_STATS)} hosts, sent {sent // 1024} KB of {size // 1024} KB")
+    for host, t in sorted(TRANSFER_STATS.items()):
+        print(f"   {host}: {t['mode']}, saved {t['saved'] // 1024} KB")
+
+# Template Sync
+# Local and remote template sets are compared as {relative path: sha256} manifests; only the
+# difference is sent, as a single tar.gz stream per host.
+TEMPLATES_DIR = "templates"
+REMOTE_TEMPLATES = "~/gravity-agent/templates"
+
+_LOCAL_MANIFEST = None
+
+def local_template_manifest():
+    global _LOCAL_MANIFEST
+    if _LOCAL_MANIFEST is None:
+        manifest = {}
+        for root, _, files in os.walk(TEMPLATES_DIR):
+            for fname in files:
+                path = os.path.join(root, fname)
+                manifest[os.path.relpath(path, TEMPLATES_DIR)] = file_digest(path)
+        _LOCAL_MANIFEST = manifest
+    return _LOCAL_MANIFEST
+
+@traced("templates")
+def sync_templates(ssh_host, remote_manifest):
+    """Bring the remote templates in line with the local set.
+
+    Returns the list of changed paths ([] when already in sync), or None on failure.
+    """
+    if not os.path.isdir(TEMPLATES_DIR):
+        return []
+    local = local_template_manifest()
+    remote = remote_manifest or {}
+    changed = sorted(p for p, h in local.items() if remote.get(p) != h)
+    removed = sorted(p for p in remote if p not in local)
+    if not changed and not removed:
+        return []
+
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:gz") as tar:
+        for rel in changed:
+            tar.add(os.path.join(TEMPLATES_DIR, rel), arcname=rel)
+    cmd = f"mkdir -p {REMOTE_TEMPLATES} && tar -xzf - -C {REMOTE_TEMPLATES}"
+    if removed:
+        cmd += f" && cd {REMOTE_TEMPLATES} && rm -f -- {' '.join(shlex.quote(p) for p in removed)}"
+    ret = run_ssh(ssh_host, cmd, input=buf.getvalue())
+    if ret.returncode != 0:
+        print(f"❌ Template sync failed: {redact_secrets(ret.stderr.strip())}")
+        return None
+    span_attr(bytes=len(buf.getvalue()))
+    print(f"📤 Templates synced: {len(changed)} updated, {len(removed)} removed ({len(buf.getvalue()) // 1024} KB)")
+    return changed + removed
+
+# Fleet State Store
+# Last observed/applied state per agent, so check_and_fix can skip the full probe for
+# agents whose cached state already matches the desired state.
+STATE_DB = os.path.join(CACHE_DIR, "fleet_state.db")
+STATE_FRESH_SECONDS = int(os.getenv("STATE_FRESH_SECONDS", "3600") or 0)
+STATE_FIELDS = ("ssh_host", "arch", "binary_digest", "template_digest", "config_hashes", "env_hash",
+                "deps_ok", "observed_at", "applied_at", "last_healthy", "deps_versions", "release")
+# Columns added after the table was first created: name -> type
+STATE_MIGRATIONS = {"deps_versions": "TEXT", "release": "TEXT"}
 
+_STATE_INIT = threading.Lock()
+_STATE_READY = False
+
+@contextlib.contextmanager
+def _state_conn():
+    global _STATE_READY
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    conn = sqlite3.connect(STATE_DB, timeout=30)
+    conn.row_factory = sqlite3.Row
+    try:
+        with _STATE_INIT:
+            if not _STATE_READY:
+                conn.execute("""CREATE TABLE IF NOT EXISTS agents (
+                    name TEXT PRIMARY KEY, ssh_host TEXT, arch TEXT, binary_digest TEXT,
+                    template_digest TEXT, config_hashes TEXT, env_hash TEXT, deps_ok INTEGER,
+                    observed_at REAL, applied_at REAL, last_healthy REAL)""")
+                have = {row["name"] for row in conn.execute("PRAGMA table_info(agents)")}
+                for col, kind in STATE_MIGRATIONS.items():
+                    if col not in have:
+                        conn.execute(f"ALTER TABLE agents ADD COLUMN {col} {kind}")
+                _STATE_READY = True
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+def state_get(name):
+    with _state_conn() as conn:
+        row = conn.execute("SELECT * FROM agents WHERE name = ?", (name,)).fetchone()
+    if row is None:
+        return None
+    row = dict(row)
+    row["config_hashes"] = json.loads(row["config_hashes"] or "{}")
+    row["deps_versions"] = json.loads(row["deps_versions"] or "{}")
+    return row
+
+def state_put(name, **fields):
+    """Upsert the given fields for an agent (other columns are left untouched)."""
+    unknown = set(fields) - set(STATE_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown state fields: {sorted(unknown)}")
+    for key in ("config_hashes", "deps_versions"):
+        if key in fields:
+            fields[key] = json.dumps(fields[key], sort_keys=True)
+    cols = ", ".join(["name", *fields])
+    marks = ", ".join("?" * (len(fields) + 1))
+    updates = ", ".join(f"{k} = excluded.{k}" for k in fields) or "name = name"
+    with _state_conn() as conn:
+        conn.execute(f"INSERT INTO agents ({cols}) VALUES ({marks}) ON CONFLICT(name) DO UPDATE SET {updates}",
+                     (name, *fields.values()))
+
+def state_forget(name):
+    with _state_conn() as conn:
+        conn.execute("DELETE FROM agents WHERE name = ?", (name,))
+
+def manifest_digest(manifest):
+    return hashlib.sha256(json.dumps(manifest, sort_keys=True).encode()).hexdigest()
+
+def _cached_state_matches(name, ssh_host, fresh_window, desired_config=None):
+    """Return the cached state row if it is fresh and matches the desired state, else None."""
+    cached = state_get(name)
+    if not cached or cached["ssh_host"] != ssh_host or not cached["observed_at"]:
+        return None
+    if time.time() - cached["observed_at"] > fresh_window:
+        return None
+    if not cached["deps_ok"] or not cached["env_hash"] or not all(cached["config_hashes"].values() or [None]):
+        return None
+    local_binary = get_artifact(cached["arch"])
+    if not local_binary or file_digest(local_binary) != cached["binary_digest"]:
+        return None
+    if os.path.isdir(TEMPLATES_DIR) and manifest_digest(local_template_manifest()) != cached["template_digest"]:
+        return None
+    if desired_config is not None:
+        # Rendered config changed locally (or the check path recorded drift on the host)
+        if config_hashes(desired_config) != cached["config_hashes"]:
+            return None
+        if desired_config[".env"] is not None and content_hash(desired_config[".env"]) != cached["env_hash"]:
+            return None
+    return cached
+
+# Reconciliation Planner
+# plan_agent observes a host (cached-state fast path or one probe) and diffs it against the
+# desired state into a plan: {step: {"after": [steps it waits for], "reason": ...}}. apply_plan
+# runs the steps as a DAG, so staging the binary, templates, deps, config and .env proceed
+# concurrently, and the restart (the only step that stops the service) waits for all of them.
+DAG_WORKERS = 4
+PLANS = {}  # name -> plan from plan_fleet, consumed by ensure_agent
+
+def plan_agent(name, info, args):
+    """Observe one agent and return its plan (plan["error"] is set when it can't be observed)."""
+    ssh_host = info["ssh_host"]
+    plan = {"name": name, "ssh_host": ssh_host, "cached": False, "error": None, "steps": {}}
+
+    # Fast path: cached state is fresh and already matches, only liveness needs checking
+    desired = render_config(name, info, args)
+    fresh_window = getattr(args, "fresh_window", STATE_FRESH_SECONDS)
+    if not getattr(args, "full_scan", False) and _cached_state_matches(name, ssh_host, fresh_window, desired):
+        plan["cached"] = True
+        return plan
+
+    state = PROBED.pop(ssh_host, None) or probe_remote(ssh_host)
+    if state is None:
+        plan["error"] = "probe failed"
+        return plan
+    arch = host_arch(ssh_host, info, state)
+    if desired_release() is None:
+        local_binary = None  # Every known release is held back: keep whatever binary the host runs
+    else:
+        local_binary = get_artifact(arch)
+        if not local_binary:
+            plan["error"] = "artifact unavailable"
+            return plan
+    plan.update(state=state, arch=arch, release=state.get("release") or None, artifact=local_binary,
+                digest=file_digest(local_binary) if local_binary else state["binary"]["digest"],
+                remote_templates=state["templates"], config_hashes=config_hashes(desired),
+                env_hash=content_hash(desired[".env"]) if desired[".env"] is not None else state["env_digest"])
+
+    steps = plan["steps"]
+    remote_digest = state["binary"]["digest"]
+    if plan["digest"] != remote_digest:
+        steps["binary"] = {"after": [], "reason": f"{remote_digest[:8] if remote_digest else 'missing'} -> {plan['digest'][:8]}"}
+    remote_config = {**state["config"], ".env": state["env_digest"]}
+    drift = config_drift(desired, remote_config)
+    if drift:
+        plan["config_files"] = {key: desired[key] for key in drift}
+        steps["config"] = {"after": [], "reason": ", ".join(
+            f"{key} {'changed' if remote_config.get(key) else 'missing'}" for key in drift)}
+    if os.path.isdir(TEMPLATES_DIR):
+        local = local_template_manifest()
+        changed = [p for p, h in local.items() if state["templates"].get(p) != h]
+        stale = [p for p in state["templates"] if p not in local]
+        if changed or stale:
+            steps["templates"] = {"after": [], "reason": f"{len(changed)} changed, {len(stale)} stale"}
+    missing_deps = [p for p, ok in state["deps"].items() if not ok]
+    if missing_deps:
+        steps["deps"] = {"after": [], "reason": f"missing {', '.join(missing_deps)}"}
+    if steps:
+        steps["restart"] = {"after": list(steps), "reason": "apply changes"}
+    elif not state["process"]["pid"]:
+        steps["restart"] = {"after": [], "reason": "not running"}
+    return plan
+
+def describe_plan(plan):
+    if plan["error"]:
+        return f"error: {plan['error']}"
+    if plan["cached"]:
+        return "liveness check (cached state matches)"
+    if not plan["steps"]:
+        return "up to date"
+    return ", ".join(f"{step} ({spec['reason']})" for step, spec in plan["steps"].items())
+
+def plan_fleet(targets, args):
+    """Plan every target concurrently and print the fleet plan. Returns {name: plan}."""
+    print(f"\n📝 Planning {len(targets)} agents...")
+
+    def plan_one(name, info):
+        PLANS[name] = plan_agent(name, info, args)
+        return not PLANS[name]["error"], describe_plan(PLANS[name])
+
+    results = run_parallel(targets, plan_one, args.concurrency)
+    changed = sum(1 for r in results if PLANS.get(r["name"], {}).get("steps"))
+    width = max([len("Agent")] + [len(r["name"]) for r in results])
+    print(f"\n📝 Plan: {len(results)} agents, {changed} with changes")
+    for r in results:
+        print(f"{r['name']:<{width}}  {r['detail']}")
+    return {r["name"]: PLANS.get(r["name"]) for r in results}
+
+def run_dag(steps, actions, max_workers=DAG_WORKERS):
+    """Run actions[step]() -> bool once every step in steps[step]["after"] succeeded.
+
+    Returns {step: True | False | None}, None meaning skipped because a prerequisite failed.
+    Output and span context of the calling host worker carry over to the step threads.
+    """
+    out = sys.stdout
+    buf = getattr(out.local, "buf", None) if isinstance(out, HostOutput) else None
+    agent = getattr(_CTX, "agent", None)
+    deadline = getattr(_CTX, "deadline", None)
+
+    def call(step):
+        if isinstance(out, HostOutput):
+            out.local.buf = buf
+        _CTX.agent, _CTX.deadline = agent, deadline
+        try:
+            return bool(actions[step]())
+        except Exception as e:
+            print(f"❌ Step {step} failed: {redact_secrets(e)}")
+            return False
+        finally:
+            if isinstance(out, HostOutput):
+                out.local.buf = None
+            _CTX.agent, _CTX.deadline = None, None
+
+    done, running = {}, {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while len(done) < len(steps):
+            for step, spec in steps.items():
+                if step in done or step in running:
+                    continue
+                if any(dep in done and not done[dep] for dep in spec["after"]):
+                    done[step] = None
+                elif all(done.get(dep) for dep in spec["after"]):
+                    running[step] = pool.submit(call, step)
+            if not running:
+                # Nothing runnable left: remaining steps wait on steps outside the plan
+                done.update({step: None for step in steps if step not in done})
+                break
+            finished, _ = wait(list(running.values()), return_when=FIRST_COMPLETED)
+            for step, fut in list(running.items()):
+                if fut in finished:
+                    done[step] = fut.result()
+                    del running[step]
+    return done
+
+def apply_plan(name, info, plan, args):
+    """Execute a plan for one agent. Returns (ok, detail)."""
+    ssh_host = info["ssh_host"]
+    if plan["error"]:
+        return False, plan["error"]
+
+    if plan["cached"]:
+        print("⚡ Cached state matches desired state, checking liveness only.")
+        if run_ssh(ssh_host, "pgrep -x gravity-agent").returncode == 0:
+            state_put(name, last_healthy=time.time())
+            print("✅ Service running.")
+            return True, "up to date (cached)"
+        print("⚠️ Service not running. Starting...")
+        return restart_agent(name, info)
+
+    steps = plan["steps"]
+
+    def config_step():
+        files = dict(plan["config_files"])
+        if ".env" in files and files[".env"] is None:
+            env = render_env(name, info, args)  # Unresolvable tunnel: alerts and fails the step
+            if env is None:
+                return False
+            files[".env"] = env.encode()
+            plan["env_hash"] = content_hash(files[".env"])
+        return push_config(ssh_host, files)
+
+    def restart_step():
+        plan["restart"] = restart_agent(name, info)
+        return plan["restart"][0]
+
+    actions = {
+        "binary": lambda: push_binary(ssh_host, plan["artifact"]),
+        "templates": lambda: sync_templates(ssh_host, plan.get("remote_templates") or {}) is not None,
+        "deps": lambda: install_dependencies(ssh_host, plan["arch"], plan.get("release")),
+        "config": config_step,
+        "restart": restart_step,
+    }
+    for step, spec in steps.items():
+        print(f"🧩 {step}: {spec['reason']}" + (f" (after {', '.join(spec['after'])})" if spec["after"] else ""))
+    done = run_dag(steps, actions)
+
+    failed = [step for step, ok in done.items() if ok is False]
+    skipped = [step for step, ok in done.items() if ok is None]
+    if failed:
+        return False, f"{'+'.join(failed)} failed" + (f", skipped {'+'.join(skipped)}" if skipped else "")
+    changes = [step for step in steps if step != "restart"]
+    restart_detail = plan["restart"][1] if "restart" in steps else None
+
+    # Record what the host looks like now (desired state, since every step succeeded)
+    if "state" in plan:
+        state = plan["state"]
+        now = time.time()
+        observed = {
+            "ssh_host": ssh_host, "arch": plan["arch"], "release": plan["release"], "binary_digest": plan["digest"],
+            "template_digest": manifest_digest(local_template_manifest()) if os.path.isdir(TEMPLATES_DIR) else None,
+            "config_hashes": plan["config_hashes"], "env_hash": plan["env_hash"], "deps_ok": 1, "observed_at": now,
+        }
+        if ssh_host in DEPS_VERSIONS:
+            observed["deps_versions"] = DEPS_VERSIONS[ssh_host]
+        if changes:
+            observed["applied_at"] = now
+        if not restart_detail:
+            observed["last_healthy"] = now
+        state_put(name, **observed)
+
+    if changes:
+        return True, f"updated {'+'.join(changes)}, {restart_detail}"
+    if restart_detail:
+        return True, f"was down, {restart_detail}"
+    print("✅ No changes needed. Service running.")
+    return True, "up to date"
+
+@traced("ensure")
 def ensure_agent(name, agents, args):
     info = agents.get(name)
     if not info:
         print(f"❌ Agent {name} not found")
-        return
+        return False, "not found"
         
     ssh_host = info.get("ssh_host")
-    public_url = info.get("url")
     if not ssh_host:
         print(f"❌ Missing ssh_host for {name}")
-        return
+        return False, "missing ssh_host"
 
     print(f"🕵️ Inspecting {name} ({ssh_host})...")
-    needs_restart = False
-
-    # 1. Download Latest Binary (Local Cache)
-    if not os.path.exists("gravity-agent"):
-        # Reuse download logic from deploy_agent
-        # But we need to separate it. For now, calling deploy_agent's download part is hard.
-        # Let's verify if we have it locally first.
-        print("⬇️  Checking/Downloading latest binary locally...")
-        # (Assuming download needs to happen if missing)
-        # Duplicate download logic for safety or refactor?
-        # Let's perform a "soft" download call or check if we can reuse.
-        # Ideally, we should refactor download out. 
-        # For this edit, I will rely on deploy_agent's flow but be smarter?
-        # No, 'ensure' needs to be standalone.
-        # I'll implement a simple download check here.
-        download_binary_only()
-
-    # 2. Version Check (MD5)
-    local_md5 = get_file_md5("gravity-agent")
-    remote_md5 = check_remote_md5(ssh_host, "~/gravity-agent/gravity-agent")
-    
-    if local_md5 != remote_md5:
-        print(f"🔄 Version Mismatch (Local: {local_md5[:8]} vs Remote: {remote_md5[:8] if remote_md5 else 'None'}). Updating Binary...")
-        
-        # STOP SERVICE first to avoid 'Text file busy'
-        run_ssh(ssh_host, "(pkill -9 -x gravity-agent || true)")
-        
-        # Transfer Binary Logic
-        run_ssh(ssh_host, "mkdir -p ~/gravity-agent")
-        subprocess.run(["sshpass", "-p", SSH_PASS, "scp", "-o", "StrictHostKeyChecking=no", "gravity-agent", f"{SSH_USER}@{ssh_host}:~/gravity-agent/"])
-        run_ssh(ssh_host, "chmod +x ~/gravity-agent/gravity-agent")
-        needs_restart = True
-        
-        # Also Update Templates/Env if binary changed (often generally good practice)
-        if os.path.exists("templates"):
-            subprocess.run(["sshpass", "-p", SSH_PASS, "scp", "-r", "-o", "StrictHostKeyChecking=no", "templates", f"{SSH_USER}@{ssh_host}:~/gravity-agent/"])
-            
-        # Regen Env
-        # We need to resolve tunnel id only if we are creating env
-        # If env exists it might be fine, but if we updated binary we might want to refresh env?
-        # Let's check env existence
-        if run_ssh(ssh_host, "[ -f ~/gravity-agent/.env ]").returncode != 0:
-            print("⚠️ .env missing, generating...")
-            # We need full deploy logic for env generation
-            # Calling full deploy_agent might be easier but it blindly restarts.
-            # Let's call deploy_agent fully if binary mismatch?
-            # User said: "Skip if version is latest".
-            # So if mismatch -> Deploy.
-            print("🚀 Triggering Full Deploy for Version Update...")
-            deploy_agent(name, agents, args) 
-            return # Deploy handles restart
-    else:
-        print(f"✅ Version matches ({local_md5[:8]}). Skipping Binary Update.")
+    plan = PLANS.pop(name, None) or plan_agent(name, info, args)
+    if "state" in plan:
+        state = plan["state"]
+        uptime = state["process"]["uptime"]
+        print(f"   PID: {state['process']['pid'] or '-'}, Uptime: {'-' if uptime is None else uptime}s, "
+              f"Disk Free: {(state['disk_free_kb'] or 0) // 1024} MB")
+    ok, detail = apply_plan(name, info, plan, args)
+    if not ok:
+        state_forget(name)
+    return ok, detail
 
-    # 3. Dependency Check
-    if not check_remote_deps(ssh_host):
-        print("📦 Missing Dependencies. Installing...")
-        install_dependencies(ssh_host)
-        needs_restart = True
-    else:
-        print("✅ Dependencies installed.")
+# Release Artifact Cache
+# Content-addressed store: blobs/<sha256>, plus index.json mapping release tag -> asset -> digest.
+ARTIFACT_DIR = os.path.join(CACHE_DIR, "artifacts")
+ARTIFACT_KEEP = 3  # Releases kept locally (older blobs are pruned)
+DEFAULT_ARCH = "arm64"
+RELEASES_URL = f"{GITHUB_API}/repos/suwei8/GravityBridge-Go/releases/latest"
 
-    # 4. Config Check
-    if not check_remote_config(ssh_host):
-        print("⚙️  Missing Gemini Config. Configuring...")
-        configure_gemini(ssh_host)
-        needs_restart = True
-    else:
-        print("✅ Gemini Config present.")
+_ARTIFACT_LOCK = threading.RLock()
+_ARTIFACTS = {}  # (tag, arch) -> verified local path
+_RELEASE_INDEX = None
 
-    # 5. Restart if needed
-    if needs_restart:
-        print("🔄 Changes detected. Restarting service...")
-        restart_services({name: info})
-    else:
-        print("✅ No changes needed. Service should be running.")
-        # Optional: Check if running, if not restart?
-        # User said "Skip if exists...". If service is dead but latest, should likely start it.
-        if run_ssh(ssh_host, "pgrep -f gravity-agent").returncode != 0:
-             print("⚠️ Service not running. Starting...")
-             restart_services({name: info})
-
-def download_binary_only():
-    if os.path.exists("gravity-agent"): return
-    print("⬇️ Downloading latest binary...")
-    url = "https://api.github.com/repos/suwei8/GravityBridge-Go/releases/latest"
-    headers = {"Authorization": f"token {GH_TOKEN}"} if GH_TOKEN else {}
-    resp = requests.get(url, headers=headers)
-    resp.raise_for_status()
-    data = resp.json()
-    asset_url = None
-    for asset in data.get("assets", []):
-         if asset["name"] == "gravity-agent-linux-arm64":
-             asset_url = asset["url"]
-             break
-    if asset_url:
-        headers["Accept"] = "application/octet-stream"
-        with requests.get(asset_url, headers=headers, stream=True) as r:
-            with open("gravity-agent", "wb") as f:
-                shutil.copyfileobj(r.raw, f)
-        os.chmod("gravity-agent", 0o755)
+def normalize_arch(machine):
+    machine = (machine or "").strip().lower()
+    return {"aarch64": "arm64", "arm64": "arm64", "x86_64": "amd64", "amd64": "amd64",
+            "armv7l": "arm", "armhf": "arm"}.get(machine, machine or DEFAULT_ARCH)
+
+def _asset_name(arch):
+    return f"gravity-agent-linux-{arch}"
+
+def _load_release_index():
+    path = os.path.join(ARTIFACT_DIR, "index.json")
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"latest": None, "order": [], "releases": {}}
+
+def _save_release_index(index):
+    os.makedirs(ARTIFACT_DIR, exist_ok=True)
+    path = os.path.join(ARTIFACT_DIR, "index.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(index, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+def refresh_release_index():
+    """Fetch the latest release metadata once per run, using ETag so an unchanged release costs a 304."""
+    global _RELEASE_INDEX
+    with _ARTIFACT_LOCK:
+        if _RELEASE_INDEX is not None:
+            return _RELEASE_INDEX
+        index = _load_release_index()
+        headers = {"Accept": "application/vnd.github.v3+json"}
+        if GH_TOKEN:
+            headers["Authorization"] = f"token {GH_TOKEN}"
+        try:
+            data, status = cached_get_json("github", RELEASES_URL, headers)
+            if status == 304 and data["tag_name"] in index["releases"]:
+                print(f"✅ Release {data['tag_name']} unchanged (cached).")
+            else:
+                tag = data["tag_name"]
+                known = index["releases"].get(tag, {})
+                assets = {}
+                for asset in data.get("assets", []):
+                    if not asset["name"].startswith("gravity-agent-linux-"):
+                        continue
+                    digest = asset.get("digest") or ""
+                    digest = digest.split(":", 1)[1] if digest.startswith("sha256:") else None
+                    # Re-indexed tag (the ETag also changes with download_count): without a GitHub digest,
+                    # keep the one computed locally for the same asset, so its blob is reused, not re-fetched
+                    prev = known.get(asset["name"], {})
+                    if not digest and prev.get("url") == asset["url"] and prev.get("size") == asset.get("size"):
+                        digest = prev.get("digest")
+                    assets[asset["name"]] = {"url": asset["url"], "size": asset.get("size"), "digest": digest}
+                index["releases"][tag] = assets
+                index["order"] = [tag] + [t for t in index["order"] if t != tag]
+                index["latest"] = tag
+                _prune_artifacts(index)
+                _save_release_index(index)
+                print(f"✅ Latest release: {tag} ({len(assets)} assets)")
+        except Exception as e:
+            print(f"⚠️ Failed to refresh release index: {redact_secrets(e)}")
+        _RELEASE_INDEX = index
+        return index
+
+def desired_release():
+    """Newest known release that has not been held back by a failed rollout (None if all are held)."""
+    index = refresh_release_index()
+    held = index.get("held", [])
+    for tag in index["order"]:
+        if tag not in held:
+            return tag
+    return None if index["order"] else index.get("latest")
+
+def previous_release(tag):
+    index = refresh_release_index()
+    order = [t for t in index["order"] if t not in index.get("held", [])]
+    older = index["order"][index["order"].index(tag) + 1:] if tag in index["order"] else []
+    return next((t for t in older if t in order), None)
+
+def hold_release(tag, held=True):
+    with _ARTIFACT_LOCK:
+        index = refresh_release_index()
+        current = set(index.get("held", []))
+        index["held"] = sorted(current | {tag} if held else current - {tag})
+        _save_release_index(index)
+
+def _prune_artifacts(index):
+    for tag in index["order"][ARTIFACT_KEEP:]:
+        index["releases"].pop(tag, None)
+    index["order"] = index["order"][:ARTIFACT_KEEP]
+    keep = {a["digest"] for r in index["releases"].values() for a in r.values() if a.get("digest")}
+    blob_dir = os.path.join(ARTIFACT_DIR, "blobs")
+    for blob in os.listdir(blob_dir) if os.path.isdir(blob_dir) else []:
+        if blob not in keep and not blob.endswith(".part"):
+            os.remove(os.path.join(blob_dir, blob))
+
+@traced("download")
+def _download_asset(asset, dest):
+    """Resumable download of a release asset into dest (a .part file is kept between attempts)."""
+    headers = {"Accept": "application/octet-stream"}
+    if GH_TOKEN:
+        headers["Authorization"] = f"token {GH_TOKEN}"
+    have = os.path.getsize(dest) if os.path.exists(dest) else 0
+    if have:
+        headers["Range"] = f"bytes={have}-"
+    with http_request("download", "GET", asset["url"], headers=headers, stream=True) as resp:
+        if resp.status_code == 416:
+            return True  # Already complete
+        resp.raise_for_status()
+        mode = "ab" if resp.status_code == 206 else "wb"
+        received = 0
+        with open(dest, mode) as f:
+            for chunk in resp.iter_content(chunk_size=1024 * 1024):
+                f.write(chunk)
+                received += len(chunk)
+        span_attr(bytes=received)
+    return True
+
+def get_artifact(arch=DEFAULT_ARCH, tag=None):
+    """Return the local path of the verified gravity-agent binary for arch (desired release by default)."""
+    arch = normalize_arch(arch)
+    index = refresh_release_index()
+    tag = tag or desired_release()
+    if not tag:
+        print("⏸️ Every known release is held back (--unhold TAG releases one)")
+        return None
+    key = (tag, arch)
+    if key in _ARTIFACTS:
+        return _ARTIFACTS[key]
+    with _ARTIFACT_LOCK:
+        if key in _ARTIFACTS:
+            return _ARTIFACTS[key]
+        asset = index["releases"].get(tag, {}).get(_asset_name(arch))
+        if not asset:
+            print(f"❌ No '{_asset_name(arch)}' asset in release {tag}")
+            return None
+        blob_dir = os.path.join(ARTIFACT_DIR, "blobs")
+        os.makedirs(blob_dir, exist_ok=True)
+        if asset.get("digest") and os.path.exists(os.path.join(blob_dir, asset["digest"])):
+            path = os.path.join(blob_dir, asset["digest"])
+        else:
+            part = os.path.join(blob_dir, f"{tag}-{arch}.part")
+            print(f"⬇️ Downloading {_asset_name(arch)} ({tag})...")
+            for attempt in range(3):
+                try:
+                    _download_asset(asset, part)
+                    break
+                except Exception as e:
+                    print(f"⚠️ Download attempt {attempt + 1} failed: {redact_secrets(e)}")
+            else:
+                return None
+            digest = file_digest(part)
+            if asset.get("digest") and digest != asset["digest"]:
+                print(f"❌ Checksum mismatch for {_asset_name(arch)} ({digest[:12]} != {asset['digest'][:12]}), discarding")
+                os.remove(part)
+                return None
+            path = os.path.join(blob_dir, digest)
+            os.replace(part, path)
+            os.chmod(path, 0o755)
+            asset["digest"] = digest
+            _save_release_index(index)
+            print(f"✅ Cached {_asset_name(arch)} ({tag}) sha256:{digest[:12]}")
+        _ARTIFACTS[key] = path
+        return path
+
+def host_arch(ssh_host, info, state=None):
+    """Agent architecture: agents.json `arch`, else the probed `uname -m`."""
+    if info.get("arch"):
+        return normalize_arch(info["arch"])
+    if state and state.get("arch"):
+        return normalize_arch(state["arch"])
+    ret = run_ssh(ssh_host, "uname -m")
+    return normalize_arch(ret.stdout if ret.returncode == 0 else None)
+
+# Peer Distribution (--distribution tree)
+# The controller uploads each artifact once per domain (the seeds). Every host holding a verified
+# copy then pushes it to one more host per round, over its own sshpass + cloudflared, so staging
+# takes ~log2(fleet) rounds. Copies land in ~/gravity-agent/.releases/<sha256>, and push_binary
+# installs from there. Hosts the tree could not reach get the usual direct transfer.
+# A seed is a full gzip copy, while a direct transfer to a host with an older binary is a block
+# delta, so a domain is only seeded when its direct transfers would add up to more than that copy:
+# typically fresh hosts, or domains with many hosts. Small fleets upgrading in place stay direct.
+DISTRIBUTION = os.getenv("MAINT_DISTRIBUTION", "direct").strip() or "direct"
+REMOTE_RELEASES = "~/gravity-agent/.releases"
+PEER_SSH_OPTS = f"-o StrictHostKeyChecking=no -o ConnectTimeout={SSH_CONNECT_TIMEOUT} -o ProxyCommand='cloudflared access ssh --hostname %h'"
+
+SEEDED = {}   # sha256 -> set of ssh_hosts holding a verified staged copy
+PROBED = {}   # ssh_host -> probe taken during distribution, reused once by plan_agent
+
+def _domain(ssh_host):
+    return ssh_host.split(".", 1)[-1]
+
+def _receive_cmd(digest, decompress=False):
+    """Remote command that reads the artifact from stdin, verifies it and keeps the newest copies."""
+    part = f"{REMOTE_RELEASES}/{digest}.part"
+    return (f"mkdir -p {REMOTE_RELEASES} && {'gzip -dc' if decompress else 'cat'} > {part} && "
+            f"[ \"$(sha256sum {part} | awk '{{print $1}}')\" = {digest} ] && mv -f {part} {REMOTE_RELEASES}/{digest} && "
+            f"{{ cd {REMOTE_RELEASES} && ls -t | grep -v '\\.part$' | tail -n +{ARTIFACT_KEEP + 1} | xargs -r rm -f; true; }} "
+            f"|| {{ rm -f {part}; exit 1; }}")
+
+def _direct_cost(path, hosts):
+    """Estimated controller bytes for push_binary to each of hosts, the delta sized on one sample host."""
+    data, _, full = _binary_payload(path, "gzip")
+    upgrades = [h for h in hosts if h["current"]]
+    delta = len(full)
+    if upgrades:
+        sigs = _remote_block_sigs(upgrades[0]["ssh_host"])
+        if sigs:
+            delta = min(len(_build_delta(data, sigs)), len(full))
+    return (len(hosts) - len(upgrades)) * len(full) + len(upgrades) * delta
+
+def _seed(ssh_host, path, digest):
+    """Controller -> seed upload."""
+    ret = run_ssh(ssh_host, _receive_cmd(digest, decompress=True), input=_binary_payload(path, "gzip")[2])
+    if ret.returncode != 0:
+        print(f"❌ Seeding {ssh_host} failed: {redact_secrets(ret.stderr.strip())}")
+        return False
+    print(f"🌱 Seeded {digest[:12]}")
+    return True
+
+def _relay(source, target, digest):
+    """Peer -> peer copy, run on the source host; the password arrives on stdin, not argv."""
+    remote = shlex.quote(_receive_cmd(digest))
+    # A failed hop exits 254, so only the source's own connection failure (255) opens its breaker
+    cmd = (f"read -r SSHPASS && export SSHPASS && "
+           f"sshpass -e ssh {PEER_SSH_OPTS} {SSH_USER}@{target} {remote} < {REMOTE_RELEASES}/{digest}; "
+           f"rc=$?; [ $rc -eq 255 ] && rc=254; exit $rc")
+    ret = run_ssh(source, cmd, input=f"{SSH_PASS}\n".encode())
+    if ret.returncode != 0:
+        print(f"❌ Relay {source} -> {target} failed (exit {ret.returncode}): {redact_secrets(ret.stderr.strip())}")
+        return False
+    print(f"🔁 Received {digest[:12]} from {source}")
+    return True
+
+@traced("distribution")
+def distribute_artifacts(targets, args):
+    """Stage the desired artifact on every target that needs it through a seed-per-domain fan-out tree."""
+    print(f"\n🌳 Distributing release {desired_release()} to {len(targets)} agents...")
+    groups = {}  # sha256 -> {"path": local artifact, "hosts": {name: host record}}
+    lock = threading.Lock()
+
+    # 1. Find out which hosts need which artifact (and which can relay)
+    def inspect(name, info):
+        ssh_host = info["ssh_host"]
+        fresh_window = getattr(args, "fresh_window", STATE_FRESH_SECONDS)
+        plan = PLANS.get(name)
+        if plan and (plan["cached"] or plan["error"]):
+            return not plan["error"], plan["error"] or "current (cached)"
+        if plan:
+            state = plan["state"]
+        elif not getattr(args, "full_scan", False) and _cached_state_matches(name, ssh_host, fresh_window):
+            return True, "current (cached)"
+        else:
+            state = probe_remote(ssh_host)
+            if state is None:
+                return False, "probe failed"
+            PROBED[ssh_host] = state
+        path = get_artifact(host_arch(ssh_host, info, state))
+        if not path:
+            return False, "artifact unavailable"
+        digest = file_digest(path)
+        if state["binary"]["digest"] == digest:
+            return True, "current"
+        host = {"ssh_host": ssh_host, "relay": all(state["peer"].values()), "has": digest in state["releases"],
+                "current": bool(state["binary"]["digest"])}
+        with lock:
+            groups.setdefault(digest, {"path": path, "hosts": {}})["hosts"][name] = host
+        return True, "staged" if host["has"] else "needs copy"
+
+    run_parallel(targets, inspect, args.concurrency)
+
+    for digest, group in groups.items():
+        hosts = group["hosts"]
+        have = [n for n, h in hosts.items() if h["has"]]
+        need = [n for n, h in hosts.items() if not h["has"]]
+
+        # 2. Seeds: one controller upload per domain with no copy yet (prefer hosts that can relay),
+        # where the direct transfers it replaces would cost more than the full copy
+        covered = {_domain(hosts[n]["ssh_host"]) for n in have}
+        domains = {}
+        for n in sorted(need, key=lambda n: not hosts[n]["relay"]):
+            domains.setdefault(_domain(hosts[n]["ssh_host"]), []).append(n)
+        seed_size = len(_binary_payload(group["path"], "gzip")[2])
+        seeds = {}
+        for dom, names in domains.items():
+            if dom in covered:
+                continue
+            direct = _direct_cost(group["path"], [hosts[n] for n in names])
+            if direct > seed_size:
+                seeds[names[0]] = hosts[names[0]]
+            else:
+                print(f"🌳 {dom}: direct transfers (~{direct // 1024} KB) undercut a seed ({seed_size // 1024} KB)")
+        results = run_parallel(seeds, lambda n, h: (_seed(h["ssh_host"], group["path"], digest), "seed"), args.concurrency)
+        done = [r["name"] for r in results if r["ok"]]
+        have += done
+        need = [n for n in need if n not in done]
 
+        # 3. Fan-out: every relaying holder sends to one more host per round, same domain first
+        rounds = 0
+        while need:
+            senders = [n for n in have if hosts[n]["relay"]]
+            pairs = {}
+            for src in senders:
+                if not need:
+                    break
+                dom = _domain(hosts[src]["ssh_host"])
+                dst = next((n for n in need if _domain(hosts[n]["ssh_host"]) == dom), need[0])
+                need.remove(dst)
+                pairs[dst] = {"ssh_host": hosts[dst]["ssh_host"], "source": hosts[src]["ssh_host"]}
+            if not pairs:
+                break
+            rounds += 1
+            results = run_parallel(pairs, lambda n, p: (_relay(p["source"], p["ssh_host"], digest), f"from {p['source']}"),
+                                   args.concurrency)
+            done = [r["name"] for r in results if r["ok"]]
+            have += done
+            need += [n for n in pairs if n not in done]
+            if not done:
+                break
 
+        SEEDED.setdefault(digest, set()).update(hosts[n]["ssh_host"] for n in have)
+        print(f"🌳 {digest[:12]}: {len(have)}/{len(hosts)} hosts staged, {len(seeds)} controller uploads, "
+              f"{rounds} relay rounds" + (f", {len(need)} fall back to direct transfer" if need else ""))
+    return SEEDED
+
+@traced("deploy")
 def deploy_agent(name, agents, args):
     info = agents.get(name)
     if not info:
         print(f"❌ Agent {name} not found in agents.json")
-        return
+        return False, "not found"
 
     # Handle object structure
     if isinstance(info, str):
         print(f"❌ Legacy agent format for {name} (no ssh_host). Cannot deploy.")
-        return
+        return False, "legacy format"
         
     ssh_host = info.get("ssh_host")
-    public_url = info.get("url")
-    
     if not ssh_host:
         print(f"❌ Missing ssh_host for {name}")
-        return
+        return False, "missing ssh_host"
 
     print(f"🚀 Deploying {name} to {ssh_host}...")
 
-    # 1. Resolve Data
-    vpc_host = ssh_host # Source of Truth for Tunnel ID
-    vless_host = public_url.replace("https://", "").replace("http://", "")
+    # 1. Resolve Data (config files rendered in memory)
+    config = render_config(name, info, args, quiet=False)
+    if config[".env"] is None:
+        return False, "tunnel id unresolved"
     
-    # Strict Automation: Resolve or Fail
-    print(f"🔍 Resolving Tunnel ID via DNS for SSH Host: {vpc_host}...")
-    tunnel_id = resolve_tunnel_id(vpc_host)
-    
-    if not tunnel_id:
-        # Check if user provided an override (still useful for debugging but not relied upon)
-        if args.tunnel_id:
-            print(f"⚠️ DNS Resolution failed, but using manual override: {args.tunnel_id}")
-            tunnel_id = args.tunnel_id
-        else:
-            msg = f"❌ **Deployment Failed**: Could not resolve Tunnel ID for `{vpc_host}`.\nEnsure the server has a Cloudflare Tunnel running and the DNS record exists."
-            print(msg)
-            send_telegram(msg)
-            return
+    # 2. Resolve Latest Binary (local artifact cache)
+    arch = host_arch(ssh_host, info)
+    local_binary = get_artifact(arch)
+    if not local_binary:
+        return False, "download failed"
 
-    print(f"✅ Resolved Tunnel ID: {tunnel_id}")
-    
-    # 2. Prepare Environment File
-    env_content = f"""AGENT_NAME={name}
-TUNNEL_ID={tunnel_id}
-PUBLIC_URL={public_url}
-WORKER_URL=https://gravity-bridge-worker.58.workers.dev
-GITHUB_TOKEN={GH_TOKEN}
-HEADLESS=true
-"""
-    # Write temp .env
-    with open(".env.tmp", "w") as f:
-        f.write(env_content)
-    
-    # 3. Download Latest Binary
-    if not os.path.exists("gravity-agent"):
-        print("⬇️ Downloading latest binary via GitHub API...")
-        release_url = "https://api.github.com/repos/suwei8/GravityBridge-Go/releases/latest"
-        headers = {"Authorization": f"token {GH_TOKEN}", "Accept": "application/vnd.github.v3+json"}
-        
-        try:
-             # 1. Get Release Info
-             resp = requests.get(release_url, headers=headers)
-             resp.raise_for_status()
-             data = resp.json()
-             
-             # 2. Find Asset URL
-             asset_url = None
-             for asset in data.get("assets", []):
-                 if asset["name"] == "gravity-agent-linux-arm64":
-                     asset_url = asset["url"]
-                     break
-            
-             if not asset_url:
-                 print("❌ Start failed: Binary 'gravity-agent-linux-arm64' not found in latest release")
-                 return
-                 
-             # 3. Stream Download Asset
-             print(f"Fetching asset from {asset_url}...")
-             headers["Accept"] = "application/octet-stream"
-             resp_dl = requests.get(asset_url, headers=headers, stream=True)
-             
-             if resp_dl.status_code == 200:
-                 with open("gravity-agent", "wb") as f:
-                     shutil.copyfileobj(resp_dl.raw, f)
-                 os.chmod("gravity-agent", 0o755)
-                 print("✅ Download successful.")
-             else:
-                 print(f"❌ Failed to download binary asset: {resp_dl.status_code}")
-                 return
+    # 3. Everything is (re)installed; the remote template manifest is unknown, so the full set is sent
+    if not os.path.exists(TEMPLATES_DIR):
+        print("⚠️ Warning: No 'templates' directory found in workspace. UI automation will fail.")
+    steps = {step: {"after": [], "reason": "deploy"} for step in ("deps", "config", "binary", "templates")
+             if step != "templates" or os.path.exists(TEMPLATES_DIR)}
+    steps["restart"] = {"after": list(steps), "reason": "deploy"}
+    plan = {"name": name, "ssh_host": ssh_host, "cached": False, "error": None, "steps": steps,
+            "arch": arch, "artifact": local_binary, "remote_templates": {}, "config_files": config}
+    ok, detail = apply_plan(name, info, plan, args)
+    if not ok:
+        return False, detail
 
-        except Exception as e:
-             print(f"❌ Download Exception: {e}")
-             return
+    print(f"✅ Deployment of {name} Complete.")
+    return ok, f"deployed, {plan['restart'][1]}"
 
-    # 4. Transfer Files
-    run_ssh(ssh_host, "mkdir -p ~/gravity-agent")
-    
-    # 0. Install Dependencies (Standardized Environment)
-    install_dependencies(ssh_host)
-    
-    # 0.5 Configure Gemini/MCP
-    configure_gemini(ssh_host)
-    
-    # Transfer Binary
-    print("📤 Transferring binary...")
-    subprocess.run(["sshpass", "-p", SSH_PASS, "scp", "-o", "StrictHostKeyChecking=no", "gravity-agent", f"{SSH_USER}@{ssh_host}:~/gravity-agent/"])
-    
-    # Transfer Templates (Recursive)
-    if os.path.exists("templates"):
-        print("📤 Transferring templates...")
-        subprocess.run(["sshpass", "-p", SSH_PASS, "scp", "-r", "-o", "StrictHostKeyChecking=no", "templates", f"{SSH_USER}@{ssh_host}:~/gravity-agent/"])
-    else:
-        print("⚠️ Warning: No 'templates' directory found in workspace. UI automation will fail.")
+@traced("check")
+def check_agent(name, info):
+    ssh_host = info.get("ssh_host")
+    print(f"checking {name} ({ssh_host})...")
+    ret = run_ssh(ssh_host, CONFIG_CHECK_SCRIPT)
+    lines = ret.stdout.splitlines()
+    if ret.returncode != 0 or not lines or lines[0] not in ("running", "stopped"):
+        print(f"❌ {name}: Check failed (exit {ret.returncode})")
+        return False, f"check failed (exit {ret.returncode})"
 
-    # Transfer .env
-    print("📤 Transferring config...")
-    subprocess.run(["sshpass", "-p", SSH_PASS, "scp", "-o", "StrictHostKeyChecking=no", ".env.tmp", f"{SSH_USER}@{ssh_host}:~/gravity-agent/.env"])
-    
+    # Config drift from the same round-trip; recorded so the next check_and_fix fast path re-plans the agent
+    keys = {path: key for key, path in CONFIG_FILES.items()}
+    remote = {keys[path]: digest for digest, path in (line.split(None, 1) for line in lines[1:] if " " in line)
+              if path in keys}
+    drift = config_drift(render_config(name, info, None), remote)
+    if drift:
+        print(f"⚠️ {name}: Config drift: {', '.join(drift)}")
+        state_put(name, config_hashes={key: remote.get(key) for key in CONFIG_FILES if key != ".env"},
+                  env_hash=remote.get(".env"))
+    note = f", config drift: {', '.join(drift)}" if drift else ""
 
-    
-    # 5. Restart
-    restart_services({name: info})
-    
-    print(f"✅ Deployment of {name} Complete.")
+    if lines[0] == "running":
+        print(f"✅ {name}: Service Running")
+        return True, "running" + note
+    print(f"❌ {name}: Service NOT Running")
+    return False, "not running" + note
 
-def check_deploy(agents):
+def check_deploy(agents, max_workers=None):
     latest_ver = get_latest_version()
     print(f"Latest Version: {latest_ver}")
     
     missing_config = []
+    targets = {}
     
     for name, info in agents.items():
         if isinstance(info, str):
@@ -565,51 +2713,324 @@ def check_deploy(agents):
             print(f"⚠️ Skipping {name}: Missing ssh_host field")
             missing_config.append(name)
             continue
-            
-        print(f"checking {name} ({ssh_host})...")
-        ret = run_ssh(ssh_host, "pgrep -f gravity-agent")
-        
-        if ret.returncode == 0:
-            print(f"✅ {name}: Service Running")
-        else:
-            print(f"❌ {name}: Service NOT Running")
+        targets[name] = info
+
+    results = run_parallel(targets, check_agent, max_workers)
+    print_summary("Check", results)
 
     if missing_config:
         msg = f"⚠️ **Configuration Missing**\nThe following agents lack `ssh_host` config:\n`{', '.join(missing_config)}`\nPlease update `agents.json`."
         send_telegram(msg)
+    return results
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--action", choices=["check", "restart", "deploy", "debug", "check_and_fix"], required=True)
-    parser.add_argument("--target", help="Specific agent name to target (required for deploy)")
-    parser.add_argument("--tunnel-id", help="Manually specify Tunnel ID for new deployments")
-    args = parser.parse_args()
-    
-    agents = get_agents()
-    
+# Rolling Deploy
+# Canary first, then waves; a wave only proceeds when its restarted agents are ready.
+# If agents that received the new binary fail, they are rolled back to the previous
+# cached release, the release is held and the remaining waves are skipped.
+
+@traced("rollback")
+def rollback_agent(name, info, tag):
+    ssh_host = info["ssh_host"]
+    print(f"⏪ Rolling back {name} to {tag}...")
+    local_binary = get_artifact(host_arch(ssh_host, info), tag)
+    if not local_binary or not push_binary(ssh_host, local_binary):
+        return False, f"rollback to {tag} failed"
+    state_forget(name)
+    ok, detail = restart_agent(name, info)
+    return ok, f"rolled back to {tag}, {detail}"
+
+def plan_waves(names, canary, wave_size):
+    waves = [names[:canary]] if canary > 0 else []
+    rest = names[max(canary, 0):]
+    size = wave_size if wave_size and wave_size > 0 else max(len(rest), 1)
+    waves += [rest[i:i + size] for i in range(0, len(rest), size)]
+    return [w for w in waves if w]
+
+def rollout(targets, fn, args):
+    """Apply fn(name, info) to targets in canary/waves gated on readiness. Returns per-agent results."""
+    release = desired_release()
+    if release and getattr(args, "distribution", DISTRIBUTION) == "tree":
+        distribute_artifacts(targets, args)
+    names, canary = list(targets), getattr(args, "canary", 1)
+    # With a fleet plan (check_and_fix), canaries and early waves are hosts that actually take the new binary
+    plans = {name: PLANS.get(name) for name in names}
+    if all(plans.values()):
+        updating = [name for name in names if "binary" in plans[name]["steps"]]
+        names = updating + [name for name in names if name not in updating]
+        canary = canary if updating else 0
+    # Hosts already running the desired binary (a previous run or the state cache): a failed restart counts
+    current = {name for name, plan in plans.items() if release and plan and (plan["cached"] or (
+        "digest" in plan and plan["state"]["binary"]["digest"] == plan["digest"]))}
+    waves = plan_waves(names, canary, getattr(args, "wave_size", 0))
+    results = []
+    for n, wave in enumerate(waves):
+        label = "Canary" if n == 0 and canary > 0 else f"Wave {n}"
+        print(f"\n🌊 {label} ({len(wave)} agents): {', '.join(wave)}")
+        started = time.time()
+        wave_targets = {name: targets[name] for name in wave}
+        wave_results = run_parallel(wave_targets, fn, args.concurrency)
+
+        # Readiness gate for everything restarted in this wave
+        restarted = {r["name"]: targets[r["name"]] for r in wave_results
+                     if r["ok"] and RESTARTED.get(r["name"], 0) >= started}
+        ready = {}
+        if restarted:
+            ready = {r["name"]: r for r in run_parallel(restarted, wait_ready, args.concurrency)}
+            for r in wave_results:
+                if r["name"] in ready:
+                    r["ok"], r["detail"] = ready[r["name"]]["ok"], f"{r['detail']}, {ready[r['name']]['detail']}"
+        results += wave_results
+
+        # Only failures on hosts that took the new binary, or already ran it and failed to come up, count
+        bad = {r["name"]: targets[r["name"]] for r in wave_results if not r["ok"] and (
+               TRANSFER_STATS.get(targets[r["name"]]["ssh_host"], {}).get("at", 0) >= started
+               or (r["name"] in current and r["name"] in ready))}
+        if not bad:
+            continue
+
+        remaining = [name for w in waves[n + 1:] for name in w]
+        # Held even without a fallback, so the next run doesn't take the canary's state as a pass
+        hold_release(release)
+        previous = previous_release(release)
+        msg = f"❌ **Rollout Halted**: release `{release}` failed on `{', '.join(bad)}` during {label.lower()}."
+        if previous:
+            rolled = {r["name"]: r for r in run_parallel(bad, lambda name, info: rollback_agent(name, info, previous), args.concurrency)}
+            for r in wave_results:
+                if r["name"] in rolled:
+                    r["detail"] = f"{r['detail']}; {rolled[r['name']]['detail']}"
+            msg += f"\nRolled back to `{previous}` and held `{release}`."
+        else:
+            msg += f"\nNo previous release cached, nothing to roll back to. Held `{release}`."
+        if remaining:
+            msg += f"\nSkipped {len(remaining)} agents."
+        print(msg)
+        send_telegram(msg)
+        results += [{"name": name, "ok": False, "detail": "skipped (rollout halted)", "seconds": 0.0} for name in remaining]
+        break
+    return results
+
+def select_targets(agents, target):
+    """Agents named in a comma-separated target ('all' or empty = whole fleet), skipping legacy entries."""
+    names = None if not target or target == "all" else [t.strip() for t in target.split(",") if t.strip()]
+    for name in names or []:
+        if name not in agents:
+            print(f"❌ Agent {name} not found")
+    return {k: v for k, v in agents.items()
+            if (names is None or k in names) and not isinstance(v, str) and v.get("ssh_host")}
+
+# Controller Daemon (--serve)
+# Keeps the inventory, HTTP pools and SSH sessions warm between cycles. The scheduled action
+# runs every --interval seconds (with jitter), and a unix control socket accepts one JSON
+# request per connection for on-demand actions, e.g.
+#   echo '{"action": "check_and_fix", "target": "agent-01"}' | socat - UNIX-CONNECT:control.sock
+# Actions never overlap: scheduled and on-demand runs share one lock.
+ACTIONS = ["check", "restart", "deploy", "debug", "check_and_fix", "logs", "search"]
+SERVE_ACTION = os.getenv("MAINT_SERVE_ACTION", "check_and_fix").strip() or "check_and_fix"
+SERVE_INTERVAL = int(os.getenv("MAINT_SERVE_INTERVAL", "300") or 300)
+SERVE_JITTER = float(os.getenv("MAINT_SERVE_JITTER", "0.1") or 0.1)  # fraction of the interval
+SERVE_SOCKET = os.getenv("MAINT_SERVE_SOCKET", "").strip() or os.path.join(CACHE_DIR, "control.sock")
+
+_SERVE_LOCK = threading.Lock()
+_SERVE_STATUS = {"started": None, "cycles": 0, "last": None}
+
+def reset_run_state():
+    """Start a new run: forget per-run results but keep sessions, HTTP pools and on-disk caches."""
+    global RUN_ID, RUN_STARTED, _RELEASE_INDEX, _LOCAL_MANIFEST, _TUNNEL_INDEX
+    RUN_ID = time.strftime("%Y%m%dT%H%M%S") + f"-{os.getpid()}"
+    RUN_STARTED = time.time()
+    with _SPANS_LOCK:
+        _SPANS.clear()
+    TRANSFER_STATS.clear()
+    RESTARTED.clear()
+    READY_TIMES.clear()
+    _ARTIFACTS.clear()
+    _RELEASE_INDEX = None  # Next lookup is a conditional request, so new releases are noticed
+    _LOCAL_MANIFEST = None
+    with _TUNNEL_LOCK:
+        _TUNNEL_INDEX = None  # Reloaded from disk; stale or unknown hostnames may re-list their zone
+        _TUNNEL_REFRESHED.clear()
+    SEEDED.clear()
+    PROBED.clear()
+    PLANS.clear()
+    UNREACHABLE.clear()
+    DEPS_VERSIONS.clear()
+    _DEPS_UNAVAILABLE.clear()
+    with _SESSIONS_LOCK:
+        for host in [h for h, sess in _SESSIONS.items() if not sess["master"]]:
+            del _SESSIONS[host]  # Retry hosts whose connection failed last time
+
+def serve_run(args, **overrides):
+    """Run one action with the daemon's arguments plus overrides. Returns a JSON-able report."""
+    run_args = argparse.Namespace(**{**vars(args), **overrides})
+    if run_args.action not in ACTIONS:
+        return {"ok": False, "error": f"unknown action {run_args.action!r}"}
+    with _SERVE_LOCK:
+        reset_run_state()
+        start = time.time()
+        try:
+            results = run_action(run_args, get_agents()) or []
+        except Exception as e:
+            print(f"❌ {run_args.action} failed: {redact_secrets(e)}")
+            report = {"ok": False, "action": run_args.action, "error": redact_secrets(e)}
+        else:
+            report = {"ok": all(r["ok"] for r in results), "action": run_args.action,
+                      "seconds": round(time.time() - start, 2), "results": results}
+    # Alerts keep draining on the notifier thread (flushed at exit), never under the lock
+    _SERVE_STATUS["last"] = {k: v for k, v in report.items() if k != "results"}
+    _SERVE_STATUS["last"]["at"] = start
+    return report
+
+def _next_delay(interval):
+    return max(1.0, interval * (1 + random.uniform(-SERVE_JITTER, SERVE_JITTER)))
+
+def serve(args):
+    """Controller loop: scheduled action plus control socket, until SIGTERM/SIGINT."""
+    import signal
+    import socketserver
+
+    stop = threading.Event()
+    wake = threading.Event()
+
+    class ControlHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            try:
+                request = json.loads(self.rfile.readline() or b"{}")
+                if not isinstance(request, dict):
+                    raise ValueError("expected a JSON object")
+                action = request.pop("action", None)
+                if action == "status":
+                    reply = {"ok": True, **_SERVE_STATUS, "sessions": len(session_stats())}
+                elif action == "wake":
+                    wake.set()
+                    reply = {"ok": True}
+                else:
+                    allowed = {"target", "full_scan", "canary", "wave_size", "unhold", "distribution", "tunnel_id"}
+                    reply = serve_run(args, action=action, **{k: v for k, v in request.items() if k in allowed})
+            except ValueError as e:
+                reply = {"ok": False, "error": f"bad request: {e}"}
+            self.wfile.write((json.dumps(reply, default=str) + "\n").encode())
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.socket)), exist_ok=True)
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+    server = socketserver.ThreadingUnixStreamServer(args.socket, ControlHandler)
+    os.chmod(args.socket, 0o600)
+    threading.Thread(target=server.serve_forever, name="control", daemon=True).start()
+
+    def shutdown(signum, frame):
+        stop.set()
+        wake.set()
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    _SERVE_STATUS["started"] = time.time()
+    print(f"🛰️ Serving: {args.serve_action} every ~{args.interval}s, control socket {args.socket}")
+    try:
+        while not stop.is_set():
+            report = serve_run(args, action=args.serve_action)
+            _SERVE_STATUS["cycles"] += 1
+            delay = _next_delay(args.interval)
+            print(f"💤 Cycle {_SERVE_STATUS['cycles']} {'OK' if report['ok'] else 'FAILED'}, next in {delay:.0f}s")
+            wake.wait(delay)
+            wake.clear()
+    finally:
+        server.shutdown()
+        server.server_close()
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        print("👋 Controller stopped.")
+
+def run_action(args, agents):
+    """Run one maintenance action over agents and report its stats. Returns the per-agent results."""
+    results = []
     if args.action == "deploy":
         if not args.target:
             print("❌ --target is required for deploy action")
-            return
-        deploy_agent(args.target, agents, args)
+            return results
+        if args.unhold:
+            hold_release(args.unhold, held=False)
+        targets = select_targets(agents, args.target)
+        results = rollout(targets, lambda name, info: deploy_agent(name, agents, args), args)
+        print_summary("Deploy", results)
     elif args.action == "check_and_fix":
+        if args.unhold:
+            hold_release(args.unhold, held=False)
         if args.target:
-             ensure_agent(args.target, agents, args)
+             print("🚀 Ensuring Agents...")
         else:
              print("🚀 Batch Ensuring All Agents...")
-             for name in agents:
-                 ensure_agent(name, agents, args)
+        targets = select_targets(agents, args.target)
+        # Fetch release metadata once before workers start resolving artifacts
+        refresh_release_index()
+        plan_fleet(targets, args)
+        if getattr(args, "plan_only", False):
+            print("🛑 --plan-only: nothing was changed.")
+            return results
+        results = rollout(targets, lambda name, info: ensure_agent(name, agents, args), args)
+        print_summary("Check & Fix", results)
     elif args.action == "check":
-        check_deploy(agents)
+        results = check_deploy(agents, args.concurrency)
     elif args.action == "restart":
-        if args.target:
-            agents = {k:v for k,v in agents.items() if k == args.target}
-        restart_services(agents)
+        results = restart_services(select_targets(agents, args.target), args.concurrency)
     elif args.action == "debug":
         if not args.target:
             print("❌ --target is required for debug action")
-            return
-        debug_agent(args.target, agents)
+            return results
+        debug_agents(agents, args.target, args.concurrency)
+    elif args.action == "logs":
+        results = collect_logs(agents, args.target, args.concurrency)
+    elif args.action == "search":
+        if not args.query:
+            print("❌ --query is required for search action")
+            return results
+        search_logs(args.query, args.target, args.since, args.limit)
+        return results
+
+    print_ready_stats()
+    print_transfer_stats()
+    print_session_stats()
+    print_phase_stats()
+    write_metrics(args.action)
+    return results
+
+def main():
+    global METRICS_DIR, HOST_BUDGET, RUN_DEADLINE
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--action", choices=ACTIONS, help="Action to run once (required unless --serve)")
+    parser.add_argument("--target", help="Agent name(s), comma-separated, or 'all' (required for deploy and debug)")
+    parser.add_argument("--tunnel-id", help="Manually specify Tunnel ID for new deployments")
+    parser.add_argument("--full-scan", action="store_true", help="Ignore cached fleet state and fully probe every agent")
+    parser.add_argument("--fresh-window", type=int, default=STATE_FRESH_SECONDS, help="Seconds a cached agent state is trusted (default: $STATE_FRESH_SECONDS or 3600)")
+    parser.add_argument("--canary", type=int, default=1, help="Agents updated (and health-checked) before the rest of the fleet (default: 1)")
+    parser.add_argument("--wave-size", type=int, default=0, help="Agents per rollout wave after the canary (default: 0 = all remaining)")
+    parser.add_argument("--unhold", metavar="TAG", help="Release a tag previously held back by a failed rollout")
+    parser.add_argument("--plan-only", action="store_true", help="check_and_fix: print the per-agent plan and exit without changing anything")
+    parser.add_argument("--query", help="search: FTS5 query over collected agent logs, e.g. 'error OR panic'")
+    parser.add_argument("--since", type=int, help="search: only lines from the last N seconds")
+    parser.add_argument("--limit", type=int, default=50, help="search: max lines shown, newest first (default: 50)")
+    parser.add_argument("--host-budget", type=float, default=HOST_BUDGET, help="Seconds each agent may take per pass before its commands are cancelled (default: $MAINT_HOST_BUDGET or 600, 0 = unbounded)")
+    parser.add_argument("--deadline", type=float, default=RUN_DEADLINE, help="Seconds the whole run may take; agents not started by then are skipped (default: $MAINT_RUN_DEADLINE or 0 = none)")
+    parser.add_argument("--concurrency", type=int, default=MAX_WORKERS, help="Max agents processed in parallel (default: $MAINT_CONCURRENCY or 8)")
+    parser.add_argument("--distribution", choices=["direct", "tree"], default=DISTRIBUTION, help="Artifact delivery: straight from this machine, or seeded per domain and fanned out between agents (default: $MAINT_DISTRIBUTION or direct)")
+    parser.add_argument("--transport", choices=sorted(SSH_TRANSPORTS), default=SSH_TRANSPORT, help="SSH backend (default: $SSH_TRANSPORT or subprocess)")
+    parser.add_argument("--metrics-dir", default=METRICS_DIR, help="Where events-<run>.jsonl and gravitybridge.prom are written (default: $MAINT_METRICS_DIR or <cache>/metrics)")
+    parser.add_argument("--serve", action="store_true", help="Run as a controller daemon: scheduled checks plus a local control socket")
+    parser.add_argument("--serve-action", choices=["check", "check_and_fix"], default=SERVE_ACTION, help="Action run on every scheduled cycle (default: $MAINT_SERVE_ACTION or check_and_fix)")
+    parser.add_argument("--interval", type=int, default=SERVE_INTERVAL, help="Seconds between scheduled cycles (default: $MAINT_SERVE_INTERVAL or 300)")
+    parser.add_argument("--socket", default=SERVE_SOCKET, help="Control socket path (default: $MAINT_SERVE_SOCKET or <cache>/control.sock)")
+    args = parser.parse_args()
+
+    METRICS_DIR = args.metrics_dir
+    HOST_BUDGET, RUN_DEADLINE = args.host_budget, args.deadline
+    set_transport(args.transport)
+
+    if args.serve:
+        serve(args)
+        return
+    if not args.action:
+        parser.error("--action is required unless --serve is given")
+
+    run_action(args, get_agents())
 
 
 if __name__ == "__main__":